@@ -6,9 +6,10 @@ from tools.analysis_cones import gHits2cones_byEvtID, pixelClusters2cones_byEvtI
 from tools.analysis_pixelClusters import *
 from tools.point_source_validation import *
 from tools.allpix import *
-from tools.utils_opengate import setup_pixels, theta_phi, get_isotope_data, \
+from tools.utils_opengate import hits_attributes, setup_pixels, theta_phi, get_isotope_data, \
     set_fluorescence
 from tools.utils_plot import plot_hitsNclusters
+from tools.compton import emission_lines_keV
 
 um, mm, keV, MeV, deg, Bq, sec = g4_units.um, g4_units.mm, g4_units.keV, g4_units.MeV, g4_units.deg, g4_units.Bq, g4_units.s
 
@@ -59,7 +60,8 @@ if __name__ == "__main__":
     hits = sim.add_actor('DigitizerHitsCollectionActor', 'Hits')
     hits.attached_to = sensor.name
     hits.authorize_repeated_volumes = True
-    hits.attributes = opengate_core.GateDigiAttributeManager.GetInstance().GetAvailableDigiAttributeNames()
+    hits.attributes = hits_attributes(['allpix', 'cones'])  # only what offline stages read, see hits_attributes_per_stage
+    # hits.attributes = opengate_core.GateDigiAttributeManager.GetInstance().GetAvailableDigiAttributeNames()  # all
     hits.output_filename = 'hits.root'
 
     ## ============================
@@ -90,3 +92,12 @@ if __name__ == "__main__":
     pixelClusters = pixelHits2pixelClusters(pixelHits, npix=npix, window_ns=100, f='meas_calib')
 
     plot_hitsNclusters(pixelHits, pixelClusters, max_keV=300)
+
+    # ################# CONES #############################
+    # All gamma lines in one pass, from clusters paired by ToA as for measured data
+    # (not gHits2cones_byEvtID: with an ion source, TrackID 1 is the nucleus, not the gamma)
+    lines_MeV = 1e-3 * np.array(emission_lines_keV['U238_chain'])
+    coincidences = pixelClusters2coincidences(pixelClusters, window_ns=100, policy='best', source_MeV=lines_MeV)
+    spd = charge_speed_mm_ns(mobility_cm2_Vs=1000, bias_V=1000, thick_mm=thickness)
+    cones = pixelClusters2cones_byEvtID(coincidences, source_MeV=lines_MeV, thickness_mm=thickness,
+                                        charge_speed_mm_ns=spd)
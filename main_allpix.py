@@ -6,7 +6,8 @@ from tools.analysis_cones import gHits2cones_byEvtID, pixelClusters2cones_byEvtI
 from tools.analysis_pixelClusters import *
 from tools.point_source_validation import *
 from tools.allpix import *
-from tools.utils_opengate import setup_pixels, set_fluorescence
+from tools.utils_opengate import hits_attributes, setup_pixels, set_fluorescence
+from tools.pipeline import Pipeline
 
 um, mm, keV, MeV, deg, Bq, sec = g4_units.um, g4_units.mm, g4_units.keV, g4_units.MeV, g4_units.deg, g4_units.Bq, g4_units.s
 
@@ -43,7 +44,8 @@ if __name__ == "__main__":
     hits = sim.add_actor('DigitizerHitsCollectionActor', 'Hits')
     hits.attached_to = sensor.name
     hits.authorize_repeated_volumes = True
-    hits.attributes = opengate_core.GateDigiAttributeManager.GetInstance().GetAvailableDigiAttributeNames()
+    hits.attributes = hits_attributes(['allpix', 'cones'])  # only what offline stages read, see hits_attributes_per_stage
+    # hits.attributes = opengate_core.GateDigiAttributeManager.GetInstance().GetAvailableDigiAttributeNames()  # all
     hits.output_filename = 'hits.root'
     # hits.keep_zero_edep = True # TODO compatible with gHits2cones_byEventID ?
 
@@ -61,38 +63,46 @@ if __name__ == "__main__":
     sim.world.size = get_worldSize(sensor, source, margin=10)
 
     ## ============================
-    ## ==  RUN                   ==
+    ## ==  PIPELINE              ==
     ## ============================
-    sim.run()
-
-    ## ============================
-    ## ==  OFFLINE ANALYSIS      ==
-    ## ============================
-
+    # Stages below are only recomputed if their parameters or inputs changed (see tools/pipeline.py)
+    # => e.g. changing the clustering window does not rerun the simulation and Allpix2
+    # opengate objects cannot be fingerprinted: list the parameters that matter in 'key'
+    pipe = Pipeline(Path(sim.output_dir) / 'pipeline')
     hits_path = Path(sim.output_dir) / hits.output_filename
-    hits_df = uproot.open(hits_path)['Hits'].arrays(library='pd')
+    sim_key = [sim.random_seed, sensor.material, sensor.size, sensor.translation,
+               source.n, source.particle, source.energy.mono, source.position.translation]
+
+    # ################# SIMULATION ########################
+    pipe.add('simulation', sim.run, outputs=[hits_path], key=sim_key)
 
     # ################# PIXEL HITS ########################
-    pixelHits = gHits2allpix2pixelHits(sim, npix, config='default', log_level='FATAL')
+    # run_allpix() reads the geometry from the live simulation => the simulation is rerun if it was cached
+    pixelHits = pipe.add('pixelHits', gHits2allpix2pixelHits, sim, npix, config='default', log_level='FATAL',
+                         files=[hits_path], key=sim_key, requires=['simulation'])
 
     # ################# PIXEL CLUSTERS ####################
-    pixelClusters = pixelHits2pixelClusters(pixelHits, npix=npix, window_ns=100, f='m2')
+    pixelClusters = pipe.add('pixelClusters', pixelHits2pixelClusters, pixelHits, npix=npix, window_ns=100, f='m2')
 
     # #################### CONES ##########################
     # =======> GROUND TRUTH <=======
-    ctruth = gHits2cones_byEvtID(hits_path, source.energy.mono)
-    ctruth.to_csv(Path(sim.output_dir) / 'cones_truth.csv', index=False)
+    ctruth = pipe.add('cones_truth', gHits2cones_byEvtID, hits_path, source.energy.mono, files=[hits_path])
     # # =========> TIMEPIX <==========
     spd = charge_speed_mm_ns(mobility_cm2_Vs=1000, bias_V=1000, thick_mm=sensor.size[2])
-    ctpx = pixelClusters2cones_byEvtID(pixelClusters,
-                                            source_MeV=source.energy.mono,
-                                            thickness_mm=thickness,
-                                            charge_speed_mm_ns=spd,
-                                            to_global=[npix,sensor]  # for global coord
-                                            )
+    ctpx = pipe.add('cones_timepix', pixelClusters2cones_byEvtID, pixelClusters,
+                    source_MeV=source.energy.mono,
+                    thickness_mm=thickness,
+                    charge_speed_mm_ns=spd,
+                    to_global=[npix, sensor],  # for global coord
+                    key=sim_key)
+
+    pipe.run()
+    ctruth, ctpx = pipe.output('cones_truth'), pipe.output('cones_timepix')
+    ctruth.to_csv(Path(sim.output_dir) / 'cones_truth.csv', index=False)
     ctpx.to_csv(Path(sim.output_dir) / 'cones_timepix.csv', index=False)
 
     # ########## VALIDATION WITH POINT SOURCE #############
+    # Not in the pipeline, to always display the plots
     sp, vp, vs = source.position.translation, 0.1, (256, 256, 256)
     sth = valid_psource(ctruth, src_pos=sp, vpitch=vp, vsize=vs, plot_seq=0, plot_stk=1)
     stpx = valid_psource(ctpx, src_pos=sp, vpitch=vp, vsize=vs, plot_seq=0, plot_stk=1)
\ No newline at end of file
@@ -7,7 +7,7 @@ from tools.analysis_pixelHits import *
 from tools.analysis_pixelClusters import pixelHits2pixelClusters
 from tools.point_source_validation import *
 from tools.reco_backprojection import *
-from tools.utils_opengate import setup_pixels, theta_phi
+from tools.utils_opengate import hits_attributes, setup_pixels, theta_phi
 
 if __name__ == "__main__":
     sim, sim.output_dir = Simulation(), "output"
@@ -44,7 +44,8 @@ if __name__ == "__main__":
     hits = sim.add_actor('DigitizerHitsCollectionActor', 'Hits')
     hits.attached_to = sensor.name
     hits.authorize_repeated_volumes = True
-    hits.attributes = opengate_core.GateDigiAttributeManager.GetInstance().GetAvailableDigiAttributeNames()
+    hits.attributes = hits_attributes(['singles', 'cones'])  # only what offline stages read, see hits_attributes_per_stage
+    # hits.attributes = opengate_core.GateDigiAttributeManager.GetInstance().GetAvailableDigiAttributeNames()  # all
     hits.output_filename = 'hits.root'
     singles = sim.add_actor("DigitizerAdderActor", "Singles")
     singles.authorize_repeated_volumes = True
@@ -0,0 +1,36 @@
+# Process many simulation/measurement files in parallel and reconstruct them together
+# Can be used with an offline venv: see README.md
+
+import logging
+from types import SimpleNamespace
+import numpy as np
+from tools.batch import batch_files2cones
+from tools.utils import charge_speed_mm_ns
+
+try:
+    from opengate.logger import global_log
+    global_log.setLevel(logging.DEBUG)
+except ImportError:
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+if __name__ == "__main__":  # needed by the process pool on MacOS/Windows
+
+    # Simulation or experiment parameters
+    src_pos = [0, 0, -5]
+    npix, pitch, thickness = 256, 0.055, 1
+    sensor = SimpleNamespace(size=[npix * pitch, npix * pitch, thickness], translation=[0, 0, 5],
+                             rotation=np.identity(3))
+    spd = charge_speed_mm_ns(mobility_cm2_Vs=1000, bias_V=1000, thick_mm=thickness)
+
+    # Gate singles from several runs (use '.../*.t3pa' and calib=... for measurements)
+    clusters, cones = batch_files2cones('output/run*/singles.root', npix=npix, window_ns=100, f='simu_calib',
+                                        source_MeV=0.14, thickness_mm=thickness, charge_speed_mm_ns=spd,
+                                        to_global=[npix, sensor])
+    cones.to_csv('output/cones_batch.csv', index=False)
+
+    # ===========================
+    # = POINT SOURCE VALIDATION =
+    # ===========================
+    from tools.point_source_validation import valid_psource
+    valid_psource(cones, src_pos=src_pos, vpitch=0.1, vsize=(256, 256, 256), plot_seq=0, plot_stk=1)
@@ -0,0 +1,24 @@
+# Benchmark the offline pipeline stages on synthetic inputs from tools/synthetic.py (no opengate/Allpix2 needed)
+# Can be used with an offline venv: see README.md
+
+import os
+import logging
+from tools.benchmark import run_benchmarks, compare_benchmarks, BENCHMARK_BASELINE
+
+try:
+    from opengate.logger import global_log
+    global_log.setLevel(logging.INFO)
+except ImportError:
+    logging.basicConfig(level=logging.INFO)
+    global_log = logging.getLogger("dummy")
+
+# Number of events/hits/cones per stage (reconstruction is capped, see run_benchmarks)
+scales = (100, 1_000, 10_000)
+
+results = run_benchmarks(scales, out_csv='output/benchmark.csv')
+
+# Compare with the reference run in benchmarks/baseline.csv (update it by copying output/benchmark.csv there)
+if os.path.isfile(BENCHMARK_BASELINE):
+    regressions = compare_benchmarks(results, tolerance=0.25)
+else:
+    global_log.info(f"No {BENCHMARK_BASELINE}, benchmarks not compared")
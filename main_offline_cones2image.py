@@ -43,6 +43,9 @@ print(cones)
 from tools.reco_backprojection import reco_bp
 d = {'size': sensorsize, 'position': sensortranslation}
 vol = reco_bp(cones, vpitch=0.1, vsize=vs, det=d)
+# For volumes that do not fit in RAM, write into a memory-mapped file (or zarr/h5py array) slab by slab:
+# from tools.reco_backprojection import reco_volume_memmap
+# vol = reco_bp(cones, vpitch=0.1, vsize=vs, det=d, out=reco_volume_memmap('output/volume.dat', vs))
 
 # ===========================
 # == 3D VISUALIZATION      ==
@@ -4,7 +4,7 @@ import matplotlib.pyplot as plt
 import logging
 from tools.analysis_cones import pixelClusters2cones_byEvtID
 from tools.utils_plot import plot_hitsNclusters
-from tools.analysis_pixelClusters import pixelHits2pixelClusters
+from tools.analysis_pixelClusters import pixelHits2pixelClusters, pixelClusters2coincidences
 from tools.point_source_validation import valid_psource
 
 try:
@@ -18,6 +18,8 @@ except ImportError:
 pixelHits = pd.read_csv('output/pixelHits_250kBq_100ms.csv')
 pixelClusters = pixelHits2pixelClusters(pixelHits, npix=256, window_ns=100, f='meas_calib')
 plot_hitsNclusters(pixelHits, pixelClusters, max_keV=300)
+# Measured clusters have no EventID => pair them by ToA
+pixelClusters = pixelClusters2coincidences(pixelClusters, window_ns=200, policy='best', source_MeV=0.092)
 
 # Simulation or experiment parameters
 src_pos = [0 , 0, -5]
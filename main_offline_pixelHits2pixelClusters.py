@@ -7,6 +7,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import logging
 from tools.utils_plot import plot_hitsNclusters
+from tools.utils_profiling import save_run_report, configure_instrumentation
 
 try:
     from opengate.logger import global_log
@@ -15,6 +16,9 @@ except ImportError:
     global_log = logging.getLogger("dummy")
     global_log.addHandler(logging.NullHandler())
 
+# Optional: cProfile/tracemalloc per stage (wall time, rows and process peak RSS are always recorded)
+# configure_instrumentation(profile=True, trace_memory=True, output_dir='output/profiles')
+
 # ===========================
 # ==   INPUT PIXEL HITS    ==
 # ===========================
@@ -39,3 +43,6 @@ pixelClusters = pixelHits2pixelClusters(pixelHits, npix=256, window_ns=100, f='m
 pixelClusters_meas = pixelHits2pixelClusters(pixelHits_meas, npix=256, window_ns=100, f='meas_calib')
 
 plot_hitsNclusters(pixelHits_meas, pixelClusters_meas, max_keV=300)
+
+# Time, rows, throughput and memory of each stage
+save_run_report('output/run_report.json')
@@ -3,7 +3,9 @@ from scipy.spatial.transform import Rotation as R
 import warnings
 from tools.analysis_pixelHits import *
 import opengate
+from tools.utils_profiling import instrument
 
+@instrument('Allpix2')
 def run_allpix(sim,
                binary_path='allpix/allpix-squared/install-noG4/bin/',
                output_dir='allpix/', log_level='FATAL',
@@ -191,10 +193,14 @@ include = "PixelHit"
 def gHits2allpix2pixelHits(sim, npix,
                            binary_path='allpix/allpix-squared/install-noG4/bin/',
                            config='default',
-                           log_level='FATAL'):
+                           log_level='FATAL',
+                           calib=None):
+    """
+    calib: ToT -> energy calibration of the pixel hits, see allpixTxt2pixelHit()
+    """
     time_offset = run_allpix(sim, binary_path, output_dir='allpix/',
                              log_level=log_level, config=config)
-    pixelHits = allpixTxt2pixelHit('allpix/data.txt', n_pixels=npix)
+    pixelHits = allpixTxt2pixelHit('allpix/data.txt', n_pixels=npix, calib=calib)
     if time_offset: pixelHits[TOA] += pixelHits.groupby(EVENTID).ngroup() * 1e3
     return pixelHits
     # Lines starting with PixelHit in data.txt have:
@@ -6,8 +6,10 @@ import os
 import sys
 import pandas
 import uproot
-from .analysis_pixelHits import PIX_X_ID, PIX_Y_ID, EVENTID, ENERGY_keV, TOA
+from .analysis_pixelHits import PIX_X_ID, PIX_Y_ID, PIX_Z_ID, EVENTID, ENERGY_keV, TOA
 from tools.utils import *
+from tools.utils_profiling import instrument
+from tools.compton import compton_cosT, compton_cosT_error, get_E1max_keV, source_lines_keV, assign_lines
 
 try:
     from opengate.logger import global_log
@@ -24,31 +26,43 @@ pandas.set_option('display.float_format', lambda x: f'{x:.9}')  # G4 step: .3
 # TODO make order flexible (see below)
 cones_columns = ['EventID', 'Apex_X', 'Apex_Y', 'Apex_Z', 'Direction_X',
                  'Direction_Y', 'Direction_Z', 'cosT', 'error']
+# Added to cones when several source energies (emission lines) are given: line assigned to the event
+SOURCE_keV = 'E0 (keV)'
 
 
 # TODO: can be optimized using hits.keep_zero_edep = True in simulation settings
-def gHits2cones_byEvtID(file_path, source_MeV):
+@instrument('cones ghits')
+def gHits2cones_byEvtID(file_path, source_MeV, sigma_E_keV=0., window_keV=0.05):
+    """
+    source_MeV: source energy, or list of emission lines (e.g. 1e-3 * np.array(emission_lines_keV['Lu177']))
+     => events are assigned to the line matching their total energy deposit within window_keV
+        (larger than the rounding of tabulated lines vs Geant4 energies, e.g. 208.37 vs 208.366 keV for Lu177)
+    The primary gamma must be TrackID 1, i.e. gamma sources only (with ion sources, TrackID 1 is the nucleus)
+    sigma_E_keV: energy resolution for the cone error (see tools/compton.py), 0 for exact (ground truth) cones,
+     which then need an explicit tolerance in reco_bp()
+    """
     if not os.path.isfile(file_path):
         sys.exit(f"File {file_path} does not exist, probably no hit produced.")
     else:
         global_log.info(f"Offline [cones ghits]: START")
 
     stime = time.time()
-    hits = uproot.open(file_path)['Hits'].arrays(library='pd')
+    hits = read_hits(file_path)
     global_log.debug(f"Input {file_path} ({len(hits)} entries)")
     grouped = hits.groupby('EventID')
-    cones = []
+    cones, E1s_keV, E0s_keV = [], [], []
+    lines_keV = source_lines_keV(source_MeV)
 
     n_events_primary = 0
     n_events_full_edep = 0
     for eventid, grp in grouped:
-        apex, direction, E1 = False, False, False
+        apex, direction, E1, line = False, False, False, -1
         # Sensor received primary gamma and it interacted TODO: is this correct with radioisotope source?
         if 1 in grp['TrackID'].values:
             n_events_primary += 1
-            # All primary energy was deposited
-            if round(grp['TotalEnergyDeposit'].sum(), 6) == source_MeV:
-                # TODO round above is to avoid float precision issues
+            # All primary energy was deposited (within window_keV)
+            line = assign_lines(1e3 * grp['TotalEnergyDeposit'].sum(), lines_keV, window_keV)
+            if line >= 0:
                 n_events_full_edep += 1
                 grp = grp.sort_values('GlobalTime')  # IMPORTANT !
                 h = grp.iloc[0]
@@ -87,11 +101,17 @@ def gHits2cones_byEvtID(file_path, source_MeV):
                         diff = np.array(apex) - np.array(prepos)
                         direction = (diff / np.linalg.norm(diff)).tolist()
         if apex:
-            cosT = 1 - (0.511 * E1) / (source_MeV * (source_MeV - E1))
-            cones.append([eventid] + apex + direction + [cosT] + [200])
+            cones.append([eventid] + apex + direction)
+            E1s_keV.append(E1 * 1e3)
+            E0s_keV.append(lines_keV[line])
             # TODO make order flexible
 
-    df = pandas.DataFrame(cones, columns=cones_columns)
+    df = pandas.DataFrame(cones, columns=cones_columns[:7])
+    E1_keV, E0_keV = np.array(E1s_keV, dtype=float), np.array(E0s_keV, dtype=float)
+    df['cosT'] = compton_cosT(E0_keV, E1_keV)
+    df['error'] = compton_cosT_error(E0_keV, E1_keV, sigma_E_keV)
+    if len(lines_keV) > 1:
+        df[SOURCE_keV] = E0_keV
     global_log.debug(f"{n_events_primary} events with primary particle hitting sensor")
     global_log.debug(f"=> {n_events_full_edep} with full energy deposited in sensor")
     global_log.debug(f"  => {len(cones)} with at least one Compton interaction")
@@ -101,8 +121,10 @@ def gHits2cones_byEvtID(file_path, source_MeV):
     return df
 
 
+@instrument('cones tpx')
 def pixelClusters2cones_byEvtID(pixelClusters, source_MeV, thickness_mm,
-                                charge_speed_mm_ns, to_global=False):
+                                charge_speed_mm_ns, to_global=False, sigma_E_keV=2., sigma_pos_mm=0.03,
+                                pitch_mm=0.055, window_keV=100.):
     """
     Clusters have:
     - X/Y coordinates
@@ -121,6 +143,10 @@ def pixelClusters2cones_byEvtID(pixelClusters, source_MeV, thickness_mm,
         sensor.size = list with x,y,z lengths in mm
         sensor.translation = list with x,y,z positions of the sensor's center in mm
         sensor.rotation = 3D rotation matrix
+    source_MeV: source energy, or list of emission lines (e.g. 1e-3 * np.array(emission_lines_keV['Lu177']))
+     => events are assigned to the nearest line, if their total energy is within window_keV of it
+    sigma_E_keV, sigma_pos_mm: energy and position resolution, for the cone error (see tools/compton.py)
+    pitch_mm: pixel pitch, for the lever arm in mm (taken from sensor if to_global)
     """
 
     stime = time.time()
@@ -133,56 +159,56 @@ def pixelClusters2cones_byEvtID(pixelClusters, source_MeV, thickness_mm,
     else:
         global_log.debug(f"Input pixel cluster dataframe with ({len(pixelClusters)} entries)")
 
-    grouped = pixelClusters.groupby(EVENTID)
-    grouped = [group for group in grouped if len(group[1]) == 2]
-
-    cones = []
-
-    for eventid, group in grouped:
-        # 1) Distinguish compton vs photo-electric interactions
-        group = group.sort_values(ENERGY_keV)
-        Esum_MeV = 0.001 * (group.iloc[0][ENERGY_keV] + group.iloc[1][ENERGY_keV])
-        if abs(Esum_MeV - source_MeV) < 0.1 and group.iloc[1][ENERGY_keV] > get_E1max(source_MeV):
-            cl_photoel = group.iloc[1]
-            cl_compton = group.iloc[0]
-        else:
-            continue
-
-        # 2) Calculate depth difference
-        dZ_mm = charge_speed_mm_ns * (cl_compton[TOA] - cl_photoel[TOA])
-        dZ_frac = dZ_mm / thickness_mm
-
-        # 3) Calculate absolute depth of Compton interaction (apex)
-        z_compton = 0  # middle of sensor (in local fractional unit)
-        # TODO or use cluster size/energy ?
-
-        # 4) Complete 3D positions
-        pos_compton = [cl_compton[PIX_X_ID], cl_compton[PIX_Y_ID], z_compton]
-        pos_photoel = [cl_photoel[PIX_X_ID], cl_photoel[PIX_Y_ID], z_compton + dZ_frac]
-
-        # 5) Construct cone
-        E1_MeV = cl_compton[ENERGY_keV] / 1000
-        cosT = 1 - (0.511 * E1_MeV) / (source_MeV * (source_MeV - E1_MeV))
-        if to_global:
-            npix, sensor = to_global
-            apex = localFractional2globalCoordinates(pos_compton, sensor, npix)
-            pos_photoel = localFractional2globalCoordinates(pos_photoel, sensor, npix)
-            direction = np.array(apex) - np.array(pos_photoel)
-        else:
-            apex = pos_compton
-            direction = np.array(apex) - np.array(pos_photoel)
-        direction = (direction / np.linalg.norm(direction)).tolist()
-        cones.append([eventid] + apex + direction + [cosT] + [200])
-        # TODO make order flexible
-
-    df = pandas.DataFrame(cones, columns=cones_columns)
-    global_log.info(f"Offline [cones tpx]: {len(cones)} cones")
+    # Events with 2 clusters, as consecutive rows sorted by energy (Compton, photo-electric)
+    n = pixelClusters.groupby(EVENTID)[EVENTID].transform('size')
+    pairs = pixelClusters[n == 2].sort_values([EVENTID, ENERGY_keV], kind='stable')
+    cl_compton, cl_photoel = pairs.iloc[0::2], pairs.iloc[1::2]
+
+    # 1) Distinguish compton vs photo-electric interactions
+    E1 = cl_compton[ENERGY_keV].to_numpy(dtype=float)
+    E2 = cl_photoel[ENERGY_keV].to_numpy(dtype=float)
+    lines_keV = source_lines_keV(source_MeV)
+    line = assign_lines(E1 + E2, lines_keV, window_keV)
+    E0_keV = lines_keV[line]
+    ok = (line >= 0) & (E2 > get_E1max_keV(E0_keV))
+    cl_compton, cl_photoel, E1, E0_keV = cl_compton[ok], cl_photoel[ok], E1[ok], E0_keV[ok]
+
+    # 2) Calculate depth difference
+    dZ_mm = charge_speed_mm_ns * (cl_compton[TOA].to_numpy() - cl_photoel[TOA].to_numpy())
+    dZ_frac = dZ_mm / thickness_mm
+
+    # 3) Calculate absolute depth of Compton interaction (apex)
+    # from cluster size/ToA spread if estimated (see tools/depth.py), else middle of sensor (local fractional unit)
+    z_compton = cl_compton[PIX_Z_ID].to_numpy() if PIX_Z_ID in pairs.columns else np.zeros(len(E1))
+
+    # 4) Complete 3D positions
+    pos_compton = np.column_stack([cl_compton[PIX_X_ID], cl_compton[PIX_Y_ID], z_compton])
+    pos_photoel = np.column_stack([cl_photoel[PIX_X_ID], cl_photoel[PIX_Y_ID], z_compton + dZ_frac])
+
+    # 5) Construct cones
+    if to_global:
+        npix, sensor = to_global
+        apex = np.array(localFractional2globalCoordinates(pos_compton, sensor, npix)).reshape(-1, 3)
+        pos_photoel = np.array(localFractional2globalCoordinates(pos_photoel, sensor, npix)).reshape(-1, 3)
+        direction = apex - pos_photoel
+        lever_mm = np.linalg.norm(direction, axis=1)
+    else:
+        apex = pos_compton
+        direction = apex - pos_photoel
+        lever_mm = np.linalg.norm(direction * [pitch_mm, pitch_mm, thickness_mm], axis=1)
+    direction = direction / np.linalg.norm(direction, axis=1)[:, None]
+    cosT = compton_cosT(E0_keV, E1)
+    error = compton_cosT_error(E0_keV, E1, sigma_E_keV, sigma_pos_mm, lever_mm)
+
+    df = pandas.DataFrame(np.column_stack([cl_compton[EVENTID].to_numpy(), apex, direction, cosT, error]),
+                          columns=cones_columns).astype({EVENTID: int})
+    if len(lines_keV) > 1:
+        df[SOURCE_keV] = E0_keV
+    global_log.info(f"Offline [cones tpx]: {len(df)} cones")
     global_log_debug_df(df)
     global_log.info(f"Offline [cones tpx]: {get_stop_string(stime)}")
     return df
 
 
 def get_E1max(source_MeV):
-    me = 0.511  # MeV
-    E1max = source_MeV ** 2 / (source_MeV + me / 2)
-    return E1max
+    return get_E1max_keV(source_MeV * 1e3) / 1e3
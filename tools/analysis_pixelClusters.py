@@ -1,6 +1,9 @@
 # Functions to process pixelClusters dataframes
 
 from tools.analysis_pixelHits import *
+from tools.utils_profiling import instrument
+from tools.compton import source_lines_keV, nearest_line
+from collections import deque
 import pandas as pd
 
 try:
@@ -28,120 +31,168 @@ pd.set_option('display.float_format',
 #  => fits Compton camera applications when detector position is used for reconstruction
 pixelClusters_columns = [PIX_X_ID, PIX_Y_ID, PIXEL_ID, TOA, ENERGY_keV]  # TODO not used
 
-def is_adjacent_1D(hit, cluster, n_pix):
-    x1, y1 = get_pixID_2D(hit[PIXEL_ID], n_pix)
-    return any(
-        abs(x1 - x2) <= 1 and abs(y1 - y2) <= 1
-        for x2, y2 in
-        (get_pixID_2D(hit[PIXEL_ID], n_pix) for _, hit in cluster.iterrows())
-    )
-
-def is_adjacent_2D(hit, cluster, n_pix):
-    x1, y1 = hit[PIX_X_ID], hit[PIX_Y_ID]
-    return any(
-        abs(x1 - x2) <= 1 and abs(y1 - y2) <= 1
-        for _, h in cluster.iterrows()
-        for x2, y2 in [(h[PIX_X_ID], h[PIX_Y_ID])]
-    )
-
-def get_is_adjacent(pixelHits_columns):
-    if PIXEL_ID in pixelHits_columns:
-        return is_adjacent_1D
-    else:
-        return is_adjacent_2D
-
-def process_cluster_method1(cluster_df):
-    cluster_total_energy = cluster_df[ENERGY_keV].sum()
-    cluster_first_TOA = cluster_df[TOA].min()
-    cluster_first_eventID = int(cluster_df[EVENTID].min())
-    return pd.DataFrame({
-        EVENTID: [cluster_first_eventID],
-        ENERGY_keV: [cluster_total_energy],
-        TOA: [cluster_first_TOA]
-    })
+def get_pixXY(pixelHits, n_pix):
+    """
+    Integer pixel indices (x, y) of hits, from PIX_X_ID/PIX_Y_ID if present, else decoded from PIXEL_ID
+    """
+    if PIX_X_ID in pixelHits.columns and PIX_Y_ID in pixelHits.columns:
+        return pixelHits[PIX_X_ID].to_numpy(dtype=int), pixelHits[PIX_Y_ID].to_numpy(dtype=int)
+    return get_pixID_2D(pixelHits[PIXEL_ID].to_numpy(dtype=int), n_pix)
 
 
-def process_cluster_simu_calib(cluster, n_pixels):
+def label_clusters_window(x, y, toa, n_pix, window_ns):
     """
-    X and Y are in the sensor's local coordinates system, as in Allpix2
-    => origin = center of the lower-left pixel
+    Cluster labels of hits sorted by ToA.
+    A hit joins the current cluster if it is within window_ns of the cluster's 1st hit and adjacent
+    (8 neighbours or same pixel) to one of its hits, else it starts a new cluster.
+    Pixels of the current cluster are kept in an occupancy bitmap reused across clusters:
+    adjacency tests are O(1) and resetting costs the number of hits of the cluster.
     """
-    cluster_total_energy = cluster[ENERGY_keV].sum()
-    cluster_first_TOA = cluster[TOA].min()
-    cluster_first_eventID = int(cluster[EVENTID].min())
+    labels = np.empty(len(toa), dtype=np.int64)
+    occupied = np.zeros((n_pix + 2, n_pix + 2), dtype=bool)  # 1 pixel border => no edge checks
+    x, y, toa = (x + 1).tolist(), (y + 1).tolist(), toa.tolist()
+    members = []  # (x, y) of current cluster
+    label, wst = -1, None
+    for i, (xi, yi, ti) in enumerate(zip(x, y, toa)):
+        if not (members and ti - wst <= window_ns and occupied[xi - 1:xi + 2, yi - 1:yi + 2].any()):
+            for xm, ym in members:
+                occupied[xm, ym] = False
+            members.clear()
+            label, wst = label + 1, ti
+        occupied[xi, yi] = True
+        members.append((xi, yi))
+        labels[i] = label
+    return labels
 
-    if PIX_X_ID in cluster.columns and PIX_Y_ID in cluster.columns:
-        pixX = cluster[PIX_X_ID].to_numpy()
-        pixY = cluster[PIX_Y_ID].to_numpy()
-    else:
-        pixX, pixY = zip(*cluster[PIXEL_ID].apply(get_pixID_2D, args=(n_pixels,)))
-
-    x = sum(pixX * cluster[ENERGY_keV]) / cluster_total_energy
-    y = sum(pixY * cluster[ENERGY_keV]) / cluster_total_energy
-    return pd.DataFrame({
-        EVENTID: [cluster_first_eventID],
-        PIX_X_ID: [x],
-        PIX_Y_ID: [y],
-        ENERGY_keV: [cluster_total_energy],
-        TOA: [cluster_first_TOA]
-    })
-
-def process_cluster_meas_calibrated(cluster, n_pixels):
+
+def label_clusters_rolling(x, y, toa, n_pix, window_ns):
     """
-    X and Y are in the sensor's local coordinates system, as in Allpix2
-    => origin = center of the lower-left pixel
+    Cluster labels of hits sorted by ToA, with several clusters open at the same time (high rates).
+    A hit joins the open cluster(s) it is adjacent to (8 neighbours or same pixel), if within window_ns of their
+    1st hit, else it opens a new cluster. If it is adjacent to several open clusters, they are merged.
+    Clusters are closed (their pixels released) when the ToA of new hits passes their 1st hit + window_ns.
+    A label map of open clusters gives O(1) adjacency tests.
     """
-    cluster_total_energy = cluster[ENERGY_keV].sum()
-    cluster_first_TOA = cluster[TOA].min()
-
-    pixX, pixY = zip(*cluster[PIXEL_ID].apply(get_pixID_2D, args=(n_pixels,)))
-    x = sum(pixX * cluster[ENERGY_keV]) / cluster_total_energy
-    y = sum(pixY * cluster[ENERGY_keV]) / cluster_total_energy
-    return pd.DataFrame({
-        PIX_X_ID: [x],
-        PIX_Y_ID: [y],
-        ENERGY_keV: [cluster_total_energy],
-        TOA: [cluster_first_TOA]
-    })
-
-def process_cluster_meas_tot(cluster, n_pixels):
+    labels = np.empty(len(toa), dtype=np.int64)
+    owner = np.full((n_pix + 2, n_pix + 2), -1, dtype=np.int64)  # open cluster of each pixel, 1 pixel border
+    x, y, toa = (x + 1).tolist(), (y + 1).tolist(), toa.tolist()
+    parent = []  # merged clusters point to the cluster they were merged into
+    members = {}  # open cluster -> [(x, y)]
+    start = []  # ToA of 1st hit of each cluster
+    queue = deque()  # open clusters in order of 1st hit, i.e. of expiry
+    for i, (xi, yi, ti) in enumerate(zip(x, y, toa)):
+        while queue and ti - start[queue[0]] > window_ns:
+            c = queue.popleft()
+            for xm, ym in members.pop(c, ()):  # merged clusters have no members left
+                owner[xm, ym] = -1
+        nb = owner[xi - 1:xi + 2, yi - 1:yi + 2]
+        if nb.max() < 0:
+            c = len(parent)
+            parent.append(c)
+            start.append(ti)
+            members[c] = []
+            queue.append(c)
+        else:
+            c, *others = sorted(set(nb[nb >= 0].tolist()))  # oldest cluster is kept
+            for o in others:
+                parent[o] = c
+                merged = members.pop(o)
+                for xm, ym in merged:
+                    owner[xm, ym] = c
+                members[c] += merged
+        owner[xi, yi] = c
+        members[c].append((xi, yi))
+        labels[i] = c
+
+    # resolve merges (a cluster is always merged into an older one)
+    parent = np.array(parent, dtype=np.int64)
+    for c in range(len(parent)):
+        parent[c] = parent[parent[c]]
+    return parent[labels]
+
+
+# Cluster features (computed in pixelHits2pixelClusters if features=True), in pixel indices and ns
+# => used for depth estimation, cluster shape cuts...
+CLUSTER_SIZE = 'Size'
+X_MIN, X_MAX, Y_MIN, Y_MAX = 'X min', 'X max', 'Y min', 'Y max'  # bounding box
+TOA_SPREAD = 'ToA spread (ns)'  # last - first ToA
+VAR_X, VAR_Y, COV_XY = 'Var X', 'Var Y', 'Cov XY'  # weighted second moments around the centroid
+cluster_features_columns = [CLUSTER_SIZE, X_MIN, X_MAX, Y_MIN, Y_MAX, TOA_SPREAD, VAR_X, VAR_Y, COV_XY]
+
+# Columns of each cluster processing mode, and the hit column used as weight for the centroid:
+# 'm1' => total energy, 1st ToA and EventID only
+# 'simu_calib' => X and Y in the sensor's local coordinates system, as in Allpix2 (origin = center of the lower-left pixel)
+# 'meas_calib' => same without EventID (measured data)
+# 'meas_tot' => same with ToT instead of energy (uncalibrated measured data)
+cluster_modes = {
+    'm1': ([EVENTID, ENERGY_keV, TOA], ENERGY_keV),
+    'simu_calib': ([EVENTID, PIX_X_ID, PIX_Y_ID, ENERGY_keV, TOA], ENERGY_keV),
+    'meas_calib': ([PIX_X_ID, PIX_Y_ID, ENERGY_keV, TOA], ENERGY_keV),
+    'meas_tot': ([PIX_X_ID, PIX_Y_ID, TOT, TOA], TOT)
+}
+
+
+def aggregate_clusters(pixelHits, labels, x, y, weight=ENERGY_keV):
     """
-    X and Y are in the sensor's local coordinates system, as in Allpix2
-    => origin = center of the lower-left pixel
+    All cluster quantities in one vectorized pass over hits sorted by ToA, with their cluster labels.
+    Clusters are ordered by label, sums use the 'weight' column (energy or ToT).
+    EventID (if in pixelHits) is the smallest one of the cluster's hits.
     """
-    cluster_total_energy = cluster[TOT].sum()
-    cluster_first_TOA = cluster[TOA].min()
-
-    pixX, pixY = zip(*cluster[PIXEL_ID].apply(get_pixID_2D, args=(n_pixels,)))
-    x = sum(pixX * cluster[TOT]) / cluster_total_energy
-    y = sum(pixY * cluster[TOT]) / cluster_total_energy
-    return pd.DataFrame({
-        PIX_X_ID: [x],
-        PIX_Y_ID: [y],
-        TOT: [cluster_total_energy],
-        TOA: [cluster_first_TOA]
-    })
-
-process_cluster_functions = {
-    'm1': process_cluster_method1,
-    'simu_calib': process_cluster_simu_calib,
-    'meas_calib': process_cluster_meas_calibrated,
-    'meas_tot': process_cluster_meas_tot
-}
+    _, lab = np.unique(labels, return_inverse=True)
+    # hits grouped by cluster, still sorted by ToA within clusters
+    order = np.argsort(lab, kind='stable')
+    lab_s = lab[order]
+    starts = np.flatnonzero(np.r_[True, lab_s[1:] != lab_s[:-1]])
+    ends = np.r_[starts[1:], len(lab_s)] - 1
+    toa = pixelHits[TOA].to_numpy()[order]
+    xs, ys = x[order], y[order]
+
+    w = pixelHits[weight].to_numpy(dtype=float)
+    sum_w = np.bincount(lab, w)
+    cx = np.bincount(lab, w * x) / sum_w
+    cy = np.bincount(lab, w * y) / sum_w
+    dx, dy = x - cx[lab], y - cy[lab]
+
+    d = {
+        ENERGY_keV if weight == ENERGY_keV else TOT: sum_w,
+        TOA: toa[starts],
+        PIX_X_ID: cx,
+        PIX_Y_ID: cy,
+        CLUSTER_SIZE: np.diff(np.r_[starts, len(lab_s)]),
+        X_MIN: np.minimum.reduceat(xs, starts),
+        X_MAX: np.maximum.reduceat(xs, starts),
+        Y_MIN: np.minimum.reduceat(ys, starts),
+        Y_MAX: np.maximum.reduceat(ys, starts),
+        TOA_SPREAD: toa[ends] - toa[starts],
+        VAR_X: np.bincount(lab, w * dx * dx) / sum_w,
+        VAR_Y: np.bincount(lab, w * dy * dy) / sum_w,
+        COV_XY: np.bincount(lab, w * dx * dy) / sum_w,
+    }
+    if EVENTID in pixelHits.columns:
+        d[EVENTID] = np.minimum.reduceat(pixelHits[EVENTID].to_numpy()[order], starts).astype(int)
+    return pd.DataFrame(d)
 
 
-def new_clust(clust_list, cluster, hit, n_pixels, process_func, **kwargs):
-    process_func = process_cluster_functions[process_func]
-    clust_list.append(process_func(cluster, n_pixels, **kwargs))
-    new_cluster_df = pd.DataFrame([hit])
-    new_time_window_start = hit[TOA]
-    return new_cluster_df, new_time_window_start
+label_clusters_functions = {
+    'window': label_clusters_window,
+    'rolling': label_clusters_rolling
+}
 
 
-# TODO speed -> https://pandas.pydata.org/docs/user_guide/basics.html#iteration
-def pixelHits2pixelClusters(pixelHits, npix, window_ns, f, **kwargs):
+@instrument('pixelClusters')
+def pixelHits2pixelClusters(pixelHits, npix, window_ns, f, mode='window', features=False, mask=None):
+    """
+    f: cluster processing mode, see cluster_modes
+    features: also return cluster_features_columns (size, bounding box, ToA spread, second moments)
+    mode: 'window' => one open cluster at a time, a non-adjacent hit closes it (see label_clusters_window)
+          'rolling' => several open clusters, for high rates where clusters overlap in time
+                       (see label_clusters_rolling)
+    mask: hot pixels dropped before clustering, boolean array or path (see apply_pixel_mask)
+    """
     stime = time.time()
     global_log.info(f"Offline [pixelClusters]: START")
+    if mask is not None:
+        pixelHits = apply_pixel_mask(pixelHits, mask)
     if not len(pixelHits):
         global_log.error(f"Empty pixel hits dataframe, probably no hit produced.")
         global_log.info(f"Offline [pixelClusters]: {get_stop_string(stime)}")
@@ -149,27 +200,89 @@ def pixelHits2pixelClusters(pixelHits, npix, window_ns, f, **kwargs):
     else:
         global_log.debug(f"Input pixel hits dataframe with ({len(pixelHits)} entries)")
 
-    pixelHits = pixelHits.sort_values(by=TOA)
+    pixelHits = pixelHits.sort_values(by=TOA, kind='stable')
 
-    # 1st cluster & initialization
-    clust = pd.DataFrame([pixelHits.iloc[0]])  # Initialize with first hit
-    wst = pixelHits.iloc[0][TOA] # window start
-    clusters = []
+    x, y = get_pixXY(pixelHits, npix)
+    labels = label_clusters_functions[mode](x, y, pixelHits[TOA].to_numpy(), npix, window_ns)
 
-    is_adjacent = get_is_adjacent(pixelHits_columns)
+    columns, weight = cluster_modes[f]
+    df = aggregate_clusters(pixelHits, labels, x, y, weight=weight)
+    df = df[columns + cluster_features_columns if features else columns]
+    global_log.debug(f"{len(df)} clusters")
+    global_log_debug_df(df)
+    global_log.info(f"Offline [pixelClusters]: {get_stop_string(stime)}")
+    return df
 
-    # Loop over hits
-    for index, hit in pixelHits.iloc[1:].iterrows():
-        if hit[TOA] - wst <= window_ns and is_adjacent(hit, clust, npix):
-            clust = pd.concat([clust, hit.to_frame().T], ignore_index=True)
-        else:
-            clust, wst = new_clust(clusters, clust, hit, npix, f, **kwargs)
 
-    # Last cluster
-    new_clust(clusters, clust, hit, npix, f, **kwargs)
+def _window_groups(toa, window_ns):
+    """
+    Group index of sorted ToAs, each group spanning at most window_ns from its first element
+    Chains of ToAs separated by gaps <= window_ns are split sequentially, only when longer than window_ns.
+    """
+    is_start = np.r_[True, np.diff(toa) > window_ns]
+    chain_starts = np.flatnonzero(is_start)
+    chain_ends = np.r_[chain_starts[1:], len(toa)]
+    for s, e in zip(chain_starts, chain_ends):
+        if toa[e - 1] - toa[s] <= window_ns:
+            continue
+        while s < e:
+            is_start[s] = True
+            s = np.searchsorted(toa, toa[s] + window_ns, side='right')
+    return np.cumsum(is_start) - 1
 
-    df = pd.concat(clusters, ignore_index=True)
-    global_log.debug(f"{len(clusters)} clusters")
+
+@instrument('coincidences')
+def pixelClusters2coincidences(pixelClusters, window_ns, policy='reject', source_MeV=None):
+    """
+    Coincidences of clusters from their ToA only (measured data, without EventID)
+    Clusters sorted by ToA are grouped within window_ns of the first cluster of the group (the next cluster outside
+    the window opens a new group), so that groups do not grow without bound at high rates.
+    Groups of 1 cluster are dropped, groups of more than 2 clusters (multiples) are:
+     - policy='reject' => dropped
+     - policy='best' => reduced to the pair whose energy sum is closest to source_MeV (or to one of its lines if a list)
+    Returns the clusters of the kept pairs, with EventID = coincidence index
+    (overwritten if present), to be used with pixelClusters2cones_byEvtID().
+    """
+    stime = time.time()
+    global_log.info(f"Offline [coincidences]: START")
+    if policy not in ('reject', 'best'):
+        raise ValueError(f"Unknown policy '{policy}', use 'reject' or 'best'")
+    if policy == 'best' and (source_MeV is None or ENERGY_keV not in pixelClusters.columns):
+        raise ValueError(f"policy='best' needs source_MeV and calibrated clusters ({ENERGY_keV})")
+    if not len(pixelClusters):
+        global_log.error(f"Empty input (no clusters in dataframe).")
+        global_log.info(f"Offline [coincidences]: {get_stop_string(stime)}")
+        return pixelClusters.iloc[:0].assign(**{EVENTID: pd.Series(dtype=int)})
+
+    toa = pixelClusters[TOA].to_numpy()
+    if np.any(toa[1:] < toa[:-1]):
+        pixelClusters = pixelClusters.sort_values(by=TOA, kind='stable')
+        toa = pixelClusters[TOA].to_numpy()
+    group = _window_groups(toa, window_ns)
+    starts = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    sizes = np.diff(np.r_[starts, len(group)])
+    size = sizes[group]
+
+    keep = size == 2
+    n_multiples = np.count_nonzero(sizes > 2)
+    if policy == 'best' and n_multiples:
+        # all pairs (i, j > i) within multiples, i.e. size*(size-1)/2 per group
+        i_multi = np.flatnonzero(size > 2)
+        n_after = (starts + sizes)[group[i_multi]] - i_multi - 1
+        first = np.repeat(i_multi, n_after)
+        second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(n_after) - n_after, n_after)
+        E = pixelClusters[ENERGY_keV].to_numpy()
+        score = nearest_line(E[first] + E[second], source_lines_keV(source_MeV))[1]
+        order = np.lexsort((score, group[first]))
+        best = order[np.r_[True, group[first][order][1:] != group[first][order][:-1]]]
+        keep[first[best]] = True
+        keep[second[best]] = True
+
+    df = pixelClusters[keep].copy()
+    df[EVENTID] = np.cumsum(np.r_[True, group[keep][1:] != group[keep][:-1]]) - 1 if len(df) else []
+    global_log.debug(f"{len(sizes)} groups: {np.count_nonzero(sizes == 1)} singles, "
+                     f"{np.count_nonzero(sizes == 2)} pairs, {n_multiples} multiples ({policy})")
+    global_log.info(f"Offline [coincidences]: {len(df) // 2} coincidences")
     global_log_debug_df(df)
-    global_log.info(f"Offline [pixelClusters]: {get_stop_string(stime)}")
+    global_log.info(f"Offline [coincidences]: {get_stop_string(stime)}")
     return df
@@ -9,8 +9,8 @@ from tools.utils import *
 import matplotlib.colors as mcolors
 from matplotlib.ticker import MaxNLocator
 from tools.utils import get_pixID
-import xml.etree.ElementTree as ET
-import base64
+from tools.utils_profiling import instrument
+from tools.calibration import PixetCalibration, LinearCalibration
 import numpy as np
 
 
@@ -31,6 +31,7 @@ pandas.set_option('display.float_format', lambda x: f'{x:.9}')  # G4 steps x:.3
 PIXEL_ID = 'PixelID (int16)'
 PIX_X_ID = 'X'  # pixel X index (starts from 0, bottom left)
 PIX_Y_ID = 'Y'  # pixel Y index (starts from 0, bottom left)
+PIX_Z_ID = 'Z'  # depth, only for clusters (see analysis_pixelClusters)
 TOA = 'ToA (ns)'
 ENERGY_keV = 'Energy (keV)'
 TOT = 'ToT'
@@ -39,6 +40,7 @@ EVENTID = 'EventID'
 simulation_columns = [EVENTID]  # from Gate
 
 
+@instrument('pixelHits')
 def singles2pixelHits(file_path):
     if not os.path.isfile(file_path):
         sys.exit(f"{file_path} does not exist, probably no hit produced...")
@@ -65,29 +67,110 @@ def singles2pixelHits(file_path):
     return singles[simulation_columns + pixelHits_columns]
 
 
+def pixelHits_maps(pixelHits_df, n_pixels):
+    """
+    Count, energy sum and ToA sum per pixel, as (n_pixels, n_pixels) arrays indexed [x, y]
+    Single pass with np.bincount on pixel IDs (x * n_pixels + y)
+    """
+    ids = pixelHits_df[PIXEL_ID].to_numpy(dtype=np.int64)
+    n = n_pixels * n_pixels
+    counts = np.bincount(ids, minlength=n).reshape(n_pixels, n_pixels)
+    energy = np.bincount(ids, weights=pixelHits_df[ENERGY_keV].to_numpy(dtype=float), minlength=n)
+    toa = np.bincount(ids, weights=pixelHits_df[TOA].to_numpy(dtype=float), minlength=n)
+    return counts, energy.reshape(n_pixels, n_pixels), toa.reshape(n_pixels, n_pixels)
+
+
+# ===========================
+# ==  PIXEL MASK           ==
+# ===========================
+# Boolean (n_pixels, n_pixels) array, True = masked (hot/noisy) pixel, flattened in PixelID order
+# like the Pixet calib*.txt files. Saved as text next to them: <calib dir>/pixel_mask.txt
+PIXEL_MASK_FILE = 'pixel_mask.txt'
+_mask_cache = {}  # (path, mtime) -> mask
+
+
+def hot_pixels_mask(pixelHits, n_pixels=256, n_sigma=5., min_count=10):
+    """
+    Pixels whose hit count is above median + n_sigma * sigma, sigma from the MAD of the counts
+    (at least the Poisson sigma of the median, for sparse data) and with at least min_count hits.
+    pixelHits: DataFrame of hits, or a (n_pixels, n_pixels) count map (e.g. PixelHitsMonitor.counts)
+    """
+    if isinstance(pixelHits, np.ndarray):
+        counts = pixelHits.ravel()
+    else:
+        ids = pixelHits[PIXEL_ID].to_numpy(dtype=np.int64)
+        counts = np.bincount(ids, minlength=n_pixels * n_pixels)
+    med = np.median(counts)
+    sigma = max(1.4826 * np.median(np.abs(counts - med)), np.sqrt(med), 1.)
+    mask = (counts > med + n_sigma * sigma) & (counts >= min_count)
+    global_log.info(f"{mask.sum()} hot pixels (> {med + n_sigma * sigma:.1f} hits), "
+                    f"{counts[mask].sum() / max(counts.sum(), 1):.1%} of hits")
+    return mask.reshape(n_pixels, n_pixels)
+
+
+def save_pixel_mask(mask, path):
+    """
+    path: calibration directory (saved as PIXEL_MASK_FILE) or file path
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PIXEL_MASK_FILE)
+    np.savetxt(path, np.asarray(mask, dtype=np.uint8), fmt='%d')
+    return path
+
+
+def load_pixel_mask(path):
+    """
+    path: calibration directory (containing PIXEL_MASK_FILE) or file path, cached until the file is modified
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, PIXEL_MASK_FILE)
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _mask_cache:
+        mask = np.loadtxt(path, dtype=np.uint8).astype(bool)
+        if mask.ndim != 2 or mask.shape[0] != mask.shape[1]:
+            raise ValueError(f"{path}: pixel mask must be square, got shape {mask.shape}")
+        _mask_cache[key] = mask
+    return _mask_cache[key]
+
+
+def apply_pixel_mask(pixelHits, mask, id_column=PIXEL_ID):
+    """
+    Pixel hits without the masked pixels. mask: boolean array (see hot_pixels_mask) or path for load_pixel_mask()
+    id_column: column of pixel IDs (e.g. 'Matrix Index' for Pixet files), X/Y are used if it is missing
+    """
+    if isinstance(mask, (str, os.PathLike)):
+        mask = load_pixel_mask(mask)
+    n_pixels = mask.shape[0]
+    if id_column in pixelHits.columns:
+        ids = pixelHits[id_column].to_numpy(dtype=np.int64)
+    else:
+        ids = get_pixID(pixelHits[PIX_X_ID].to_numpy(dtype=np.int64), pixelHits[PIX_Y_ID].to_numpy(dtype=np.int64),
+                        n_pixels)
+    keep = ~mask.ravel()[ids]
+    global_log.debug(f"Pixel mask: {len(keep) - keep.sum()} / {len(keep)} hits removed")
+    return pixelHits[keep]
+
+
 def pixelHits_fig_ax(pixelHits_df, n_pixels, fig, ax,
                      log_scale=[False, False, False]):
-    df, np = pixelHits_df, n_pixels
-    x, y = zip(*df[PIXEL_ID].apply(get_pixID_2D, args=(np,)))
+    df, npix = pixelHits_df, n_pixels
+    counts, energy, toa = pixelHits_maps(df, npix)
 
     nc, ne, nt = [mcolors.LogNorm() if log else None for log in log_scale]
+    show = dict(origin='lower', extent=[0, npix, 0, npix], interpolation='nearest')
 
-    hc = ax[0].hist2d(x, y, bins=[np] * 2, range=[[0, n_pixels]] * 2, norm=nc)
-    cb = fig.colorbar(hc[3], ax=ax[0], label='Count')
+    hc = ax[0].imshow(counts.T, norm=nc, **show)
+    cb = fig.colorbar(hc, ax=ax[0], label='Count')
     cb.locator = MaxNLocator(integer=True)
     cb.update_ticks()
     ax[0].set_title('Counts')
 
-    he = ax[1].hist2d(x, y, bins=[np] * 2, weights=df[ENERGY_keV],
-                      range=[[0, np]] * 2, norm=ne,
-                      vmin=0.5 * df[ENERGY_keV].min() if not ne else None)
-    fig.colorbar(he[3], ax=ax[1], label='Energy (keV)')
+    he = ax[1].imshow(energy.T, norm=ne, vmin=0.5 * df[ENERGY_keV].min() if not ne else None, **show)
+    fig.colorbar(he, ax=ax[1], label='Energy (keV)')
     ax[1].set_title('Energy')
 
-    ht = ax[2].hist2d(x, y, bins=[np] * 2, weights=df[TOA],
-                      range=[[0, np]] * 2, norm=nt,
-                      vmin=0.9 * df[TOA].min() if not nt else None)
-    fig.colorbar(ht[3], ax=ax[2], label='ToA (ns)')
+    ht = ax[2].imshow(toa.T, norm=nt, vmin=0.9 * df[TOA].min() if not nt else None, **show)
+    fig.colorbar(ht, ax=ax[2], label='ToA (ns)')
     ax[2].set_title('Time')
 
     for a in ax:
@@ -100,16 +183,46 @@ def pixelHits_fig_ax(pixelHits_df, n_pixels, fig, ax,
     return fig, ax
 
 
-def plot_pixelHits_perEventID(pixelHits_df, n_pixels,
-                              log_scale=[False, False, False]):
-    unique_event_ids = pixelHits_df[EVENTID].unique()
-    for event_id in unique_event_ids:
-        fig, ax = plt.subplots(1, 3, figsize=(16, 4))
-        df = pixelHits_df[pixelHits_df[EVENTID] == event_id]
+def _save_events_figures(events, n_pixels, log_scale, out_dir):
+    # Runs in a worker process: matplotlib Figure without pyplot (no GUI backend)
+    from matplotlib.figure import Figure
+    paths = []
+    for event_id, df in events:
+        fig = Figure(figsize=(16, 4))
+        ax = fig.subplots(1, 3)
         pixelHits_fig_ax(df, n_pixels, fig, ax, log_scale)
-        plt.suptitle(f'Event ID: {event_id}')
-        plt.tight_layout()
-        plt.show()
+        fig.suptitle(f'Event ID: {event_id}')
+        fig.tight_layout()
+        paths.append(os.path.join(out_dir, f'pixelHits_event{event_id}.png'))
+        fig.savefig(paths[-1])
+    return paths
+
+
+def plot_pixelHits_perEventID(pixelHits_df, n_pixels,
+                              log_scale=[False, False, False], out_dir=None, n_workers=None, batch=50):
+    """
+    out_dir: save one image per event in out_dir instead of showing them, rendered in a process pool
+     (n_workers processes, default number of CPUs, events sent in batches of 'batch')
+    """
+    groups = pixelHits_df.groupby(EVENTID, sort=False)
+    if out_dir is None:
+        for event_id, df in groups:
+            fig, ax = plt.subplots(1, 3, figsize=(16, 4))
+            pixelHits_fig_ax(df, n_pixels, fig, ax, log_scale)
+            plt.suptitle(f'Event ID: {event_id}')
+            plt.tight_layout()
+            plt.show()
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    os.makedirs(out_dir, exist_ok=True)
+    events = list(groups)
+    batches = [events[i:i + batch] for i in range(0, len(events), batch)]
+    with ProcessPoolExecutor(n_workers) as ex:
+        futures = [ex.submit(_save_events_figures, b, n_pixels, log_scale, out_dir) for b in batches]
+        paths = [p for fut in futures for p in fut.result()]
+    global_log.info(f"{len(paths)} pixel hits images saved in {out_dir}")
+    return paths
 
 
 def plot_pixelHits_comparison(pixelHits_df1, pixelHits_df2, n_pixels,
@@ -126,9 +239,11 @@ def plot_pixelHits_comparison_perEventID(pixelHits_df1, pixelHits_df2,
                                          log_scale=[False, False, False]):
     unique_event_ids = pixelHits_df1[EVENTID].unique()
     assert (unique_event_ids == pixelHits_df2[EVENTID].unique()).all()
+    rows1 = pixelHits_df1.groupby(EVENTID).indices  # event index: EventID -> row positions
+    rows2 = pixelHits_df2.groupby(EVENTID).indices
     for event_id in unique_event_ids:
-        df1 = pixelHits_df1[pixelHits_df1[EVENTID] == event_id]
-        df2 = pixelHits_df2[pixelHits_df2[EVENTID] == event_id]
+        df1 = pixelHits_df1.iloc[rows1[event_id]]
+        df2 = pixelHits_df2.iloc[rows2[event_id]]
         fig, ax = plt.subplots(2, 3, figsize=(11, 6))
         pixelHits_fig_ax(df1, n_pixels, fig, ax[0], log_scale)
         pixelHits_fig_ax(df2, n_pixels, fig, ax[1], log_scale)
@@ -137,17 +252,12 @@ def plot_pixelHits_comparison_perEventID(pixelHits_df1, pixelHits_df2,
         plt.show()
 
 
-def pixelHits2burdaman(pixelHits_df, out_path):
-    # TODO set types correctly (else visu with TrackLab will not work)
-    # => https://software.utef.cvut.cz/tracklab/manual/a01627.html
-    # insert a column with 0s at the 3rd position
-    pixelHits_df.insert(2, 'fTOA', 0)
-    print(pixelHits_df)
-    pixelHits_df.to_csv(out_path, header=False, index=False, sep='\t')
-
-    # Dummy header
-    # TODO replace values with NaNs
-    custom_header = """# Start of measurement: 10/1/2017 17:34:41.8467094
+# Burda format (TrackLab): header lines starting with '#', then one hit per line, tab-separated integers:
+# Matrix Index, ToA (25 ns ticks), FToA (1.5625 ns ticks, subtracted), ToT
+# => https://software.utef.cvut.cz/tracklab/manual/a01627.html
+# Dummy header
+# TODO replace values with NaNs
+BURDA_HEADER = """# Start of measurement: 10/1/2017 17:34:41.8467094
 # Start of measurement - unix time: 1506872081.846
 # Chip ID: H3-W00036
 # Readout IP address: 192.168.1.105
@@ -186,18 +296,64 @@ def pixelHits2burdaman(pixelHits_df, out_path):
 # -----------------------------------------------------------------------------------------------------------------------------
 """
 
-    # Read the CSV file and add the custom header
-    with open(out_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-
-    lines.insert(0, custom_header)
 
-    # Write the modified content back to the file
-    with open(out_path, 'w', encoding='utf-8') as file:
-        file.writelines(lines)
-
-
-def allpixTxt2pixelHit(text_file, n_pixels=256):
+def pixelHits2burda_columns(pixelHits, calib=None):
+    """
+    Typed Burda columns from pixel hits (the input is not modified):
+     - Matrix Index = PixelID
+     - ToA and FToA such that ToA (ns) = 25 * ToA - 25 / 16 * FToA (exact inverse of the Pixet time calibration)
+     - ToT from the ToT column if present, else from the energy with calib.tot() (see tools/calibration.py),
+       else the energy in keV rounded (not a real ToT, a warning is logged: pass calib for Pixet files)
+    """
+    t = pixelHits[TOA].to_numpy(dtype=float) / 25
+    toa = np.ceil(t)
+    ftoa = np.clip(np.rint((toa - t) * 16), 0, 15)
+    if TOT in pixelHits.columns:
+        tot = pixelHits[TOT].to_numpy(dtype=float)
+    elif calib is not None:
+        tot = calib.tot(pixelHits[ENERGY_keV].to_numpy(), pixelHits[PIXEL_ID].to_numpy())
+    else:
+        global_log.warning("Burda ToT written as the energy in keV (no ToT column and no calib)")
+        tot = pixelHits[ENERGY_keV].to_numpy(dtype=float)
+    tot = np.clip(np.rint(np.nan_to_num(tot)), 0, None)
+    return pd.DataFrame({
+        'Matrix Index': pixelHits[PIXEL_ID].to_numpy(dtype=np.int64),
+        'ToA': toa.astype(np.int64),
+        'FToA': ftoa.astype(np.int8),
+        'ToT': tot.astype(np.int32),
+    })
+
+
+@instrument('burda')
+def pixelHits2burdaman(pixelHits, out_path, calib=None, block_rows=1_000_000):
+    """
+    Write pixel hits in the Burda format for TrackLab (see pixelHits2burda_columns), header first then data
+    pixelHits: DataFrame, or iterable of DataFrames (e.g. tpx3_pixelHits_chunks()) written chunk by chunk
+    block_rows: rows formatted at once, bounds memory for large DataFrames
+    """
+    stime = time.time()
+    global_log.info(f"Offline [burda]: START")
+    chunks = [pixelHits] if isinstance(pixelHits, pd.DataFrame) else pixelHits
+    if isinstance(calib, (str, os.PathLike)):
+        calib = PixetCalibration.load(calib)
+    n = 0
+    with open(out_path, 'w', encoding='utf-8', newline='\n', buffering=2 ** 22) as f:
+        f.write(BURDA_HEADER)
+        for chunk in chunks:
+            for i in range(0, len(chunk), block_rows):
+                block = pixelHits2burda_columns(chunk.iloc[i:i + block_rows], calib)
+                block.to_csv(f, header=False, index=False, sep='\t')
+                n += len(block)
+    global_log.info(f"Offline [burda]: {n} hits written to {out_path}")
+    global_log.info(f"Offline [burda]: {get_stop_string(stime)}")
+    return out_path
+
+
+@instrument('pixelHits')
+def allpixTxt2pixelHit(text_file, n_pixels=256, calib=None):
+    """
+    calib: ToT -> energy calibration (tools/calibration.py), default LinearCalibration() (4.43 eV per ToT unit)
+    """
     global_log.info(f"Offline [pixelHits]: START")
     global_log.debug(f"Input {text_file}")
     # TODO adapt to different simulation chains
@@ -235,12 +391,14 @@ def allpixTxt2pixelHit(text_file, n_pixels=256):
                     PIX_Y_ID: y,
                     PIXEL_ID: pixel_id,
                     TOT: tot,
-                    ENERGY_keV: tot * 4.43 / 1000,
-                    # TODO: adapt to qdc_resolution (on/off) in DefaultDigitizer
                     TOA: global_time
                 })
 
-    df = pd.DataFrame(rows, columns=simulation_columns + pixelHits_columns)
+    df = pd.DataFrame(rows, columns=simulation_columns + pixelHits_columns + [TOT])
+    # TODO: adapt to qdc_resolution (on/off) in DefaultDigitizer
+    calib = LinearCalibration() if calib is None else calib
+    df[ENERGY_keV] = calib.energy(df[TOT].to_numpy(dtype=float), df[PIXEL_ID].to_numpy(dtype=np.int64))
+    df = df[simulation_columns + pixelHits_columns]
     if len(df) == 0:
         global_log.error(f"Empty pixel hits dataframe, probably no hit produced.")
     global_log_debug_df(df)
@@ -248,7 +406,8 @@ def allpixTxt2pixelHit(text_file, n_pixels=256):
     return df
 
 
-def pixet2pixelHit(t3pa_file, calib, chipID=None, max_rows=None):
+@instrument('pixelHits')
+def pixet2pixelHit(t3pa_file, calib, chipID=None, max_rows=None, mask=None, lut=False):
     """
     Convert pixel hits and calibration from ADVACAM/PIXET to a pixelHit DataFrame.
 
@@ -256,6 +415,8 @@ def pixet2pixelHit(t3pa_file, calib, chipID=None, max_rows=None):
     * A directory containing the files caliba.txt, calibb.txt, calibc.txt, calibt.txt
       => In Pixet: Detector Setting -> More Detector Settings -> Chips -> Save
     * An XML file containing the calibration data for the chipID
+    * A PixetCalibration (tools/calibration.py), e.g. loaded once for many files
+    Directories and XML files are parsed once and cached, see PixetCalibration.load()
 
     The measurement must be done with:
     * Measurement -> Type -> Pixels
@@ -263,8 +424,18 @@ def pixet2pixelHit(t3pa_file, calib, chipID=None, max_rows=None):
     => This stores a .t3pa and a .t3pa.info file. Only the .t3pa file is needed here.
 
     The XML file and chip ID are provided when purchasing a detector.
+
+    mask: hot pixels to drop before calibration, boolean array or path (see apply_pixel_mask),
+    'calib' to use the PIXEL_MASK_FILE of the calibration directory (the directory of the XML file)
+    lut: convert ToT with a per-pixel lookup table, from calib.build_lut() (see PixetCalibration.build_lut) to reuse
+    it for many files, or True to build one for this file
     """
     df = pd.read_csv(t3pa_file, sep='\t', index_col='Index', nrows=max_rows)
+    calib = PixetCalibration.load(calib, chipID=chipID)
+    if mask is not None:
+        if isinstance(mask, str) and mask == 'calib':
+            mask = load_pixel_mask(calib.directory)
+        df = apply_pixel_mask(df, mask, id_column='Matrix Index')
 
     global_log.info(f"Offline [pixelHits]: START")
     global_log.debug(f"Inputs:\n{t3pa_file}\n{calib}")
@@ -280,56 +451,9 @@ def pixet2pixelHit(t3pa_file, calib, chipID=None, max_rows=None):
     # == ENERGY CALIBRATION    ==
     # ===========================
 
-    calib_names = ['caliba', 'calibb', 'calibc', 'calibt']
-    calib_dict = {}
-
-    if calib.endswith('xml'):
-        global_log.info(f"Offline [pixelHits]: Using XML file for calibration")
-        global_log.error("Reading calibration from XML seems wrong with current decoding")
-        tree = ET.parse(calib)
-        root = tree.getroot()
-        chip = root.find(chipID)
-        if not chip:
-            global_log.error(f"Chip {chipID} not found in XML file {calib_dict}")
-            sys.exit(1)
-        for name in calib_names:
-            calib_str = chip.find(name).text
-            if calib_str is not None:
-                decoded = base64.b64decode(calib_str)
-                arr = np.frombuffer(decoded, dtype=np.float32)
-                values = arr[1::2]
-                calib_dict[name] = values
-    elif os.path.isdir(calib):
-        global_log.info(f"Offline [pixelHits]: Searching {calib} for calib files")
-        for name in calib_names:
-            file_path = os.path.join(calib, f"{name}.txt")
-            arr = np.loadtxt(file_path)
-            if arr.shape != (256, 256):
-                raise ValueError(f"{file_path} does not have shape (256, 256)")
-            calib_dict[name] = arr.flatten()  # row-major order
-
-    def tot_to_energy(tot, a, b, c, t):
-        A = a
-        B = b - tot - a * t
-        C = -t * (b - tot) - c
-        discriminant = B ** 2 - 4 * A * C
-        if discriminant < 0 or A == 0:
-            return np.nan
-        E = (-B + np.sqrt(discriminant)) / (2 * A)
-        return E
-
-    for name in calib_names:
-        global_log.debug(f"Mean of {name}: {np.mean(calib_dict[name])}")
-
-    def compute_energy(row):
-        idx = int(row['Matrix Index'])
-        a = calib_dict['caliba'][idx]
-        b = calib_dict['calibb'][idx]
-        c = calib_dict['calibc'][idx]
-        t = calib_dict['calibt'][idx]
-        return tot_to_energy(row['ToT'], a, b, c, t)
-
-    df['Energy (keV)'] = df.apply(compute_energy, axis=1)
+    if lut is True:
+        lut = calib.build_lut()
+    df['Energy (keV)'] = calib.energy(df['ToT'].to_numpy(), df['Matrix Index'].to_numpy(), lut=lut)
 
     # ===========================
     # ==  FORMAT DATAFRAME     ==
@@ -0,0 +1,144 @@
+# Offline analysis of many files in parallel (several simulation runs, acquisitions split in many .t3pa files...)
+# Each file is processed in its own process: pixel hits -> clusters -> cones
+# Results are then concatenated with unique EventIDs and monotonic ToA, as if they were a single run.
+# Supported files:
+#  - Gate singles (.root with a 'Singles' tree) -> singles2pixelHits()
+#  - Gate hits (.root with a 'Hits' tree) -> gHits2cones_byEvtID() (ground truth cones, no clusters)
+#  - Pixet .t3pa -> pixet2pixelHit()
+#  - raw Timepix3 .tpx3 -> tpx3Raw2pixelHit()
+# When using a process pool on MacOS/Windows, call batch_files2cones() under 'if __name__ == "__main__":'.
+# The run_report records (tools/utils_profiling.py) of the stages run in the worker processes are sent back and added
+# to the run_report of the main process, before the record of the whole batch.
+
+import glob
+import time
+import uproot
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from tools.analysis_pixelHits import singles2pixelHits, pixet2pixelHit, EVENTID, TOA
+from tools.analysis_pixelClusters import pixelHits2pixelClusters, pixelClusters2coincidences
+from tools.analysis_cones import gHits2cones_byEvtID, pixelClusters2cones_byEvtID, cones_columns
+from tools.calibration import PixetCalibration
+from tools.tpx3 import tpx3Raw2pixelHit
+from tools.utils import get_stop_string, global_log_debug_df
+from tools.utils_profiling import instrument, run_report
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+
+def process_file(file_path, npix, window_ns, f, source_MeV, thickness_mm, charge_speed_mm_ns,
+                 to_global=False, calib=None, chipID=None, coinc_window_ns=None, coinc_policy='reject',
+                 mask=None):
+    """
+    pixel hits -> clusters -> cones for a single file. Returns (clusters, cones), clusters is None for Gate hits.
+    Clusters without EventID (measured data) are paired with pixelClusters2coincidences() if coinc_window_ns is set.
+    mask: hot pixels dropped before clustering (see apply_pixel_mask)
+    """
+    file_path = str(file_path)
+    if file_path.endswith('.t3pa'):
+        pixelHits = pixet2pixelHit(file_path, calib, chipID=chipID)
+    elif file_path.endswith('.tpx3'):
+        pixelHits = tpx3Raw2pixelHit(file_path, calib, chipID=chipID)
+    else:
+        with uproot.open(file_path) as froot:
+            keys = [k.split(';')[0] for k in froot.keys()]
+        if 'Singles' in keys:
+            pixelHits = singles2pixelHits(file_path)
+        elif 'Hits' in keys:
+            return None, gHits2cones_byEvtID(file_path, source_MeV)
+        else:
+            raise ValueError(f"{file_path}: no 'Hits' or 'Singles' tree")
+
+    clusters = pixelHits2pixelClusters(pixelHits, npix=npix, window_ns=window_ns, f=f, mask=mask)
+    if len(clusters) and EVENTID not in clusters.columns and coinc_window_ns is not None:
+        clusters = pixelClusters2coincidences(clusters, coinc_window_ns, policy=coinc_policy, source_MeV=source_MeV)
+    if not len(clusters) or EVENTID not in clusters.columns:
+        global_log.warning(f"{file_path}: no EventID in clusters, cannot build cones")
+        return clusters, pd.DataFrame(columns=cones_columns)
+    cones = pixelClusters2cones_byEvtID(clusters, source_MeV=source_MeV, thickness_mm=thickness_mm,
+                                        charge_speed_mm_ns=charge_speed_mm_ns, to_global=to_global)
+    return clusters, cones
+
+
+def _process_file_report(file_path, **kwargs):
+    """
+    process_file() in a worker process, also returning the run_report records of its stages
+    """
+    n = len(run_report)  # workers are reused for several files
+    clusters, cones = process_file(file_path, **kwargs)
+    return clusters, cones, run_report[n:]
+
+
+@instrument('batch')
+def batch_files2cones(files, npix=256, window_ns=100, f='simu_calib', source_MeV=None, thickness_mm=1,
+                      charge_speed_mm_ns=None, to_global=False, calib=None, chipID=None, coinc_window_ns=None,
+                      coinc_policy='reject', mask=None, n_workers=None):
+    """
+    files: glob pattern (e.g. 'output/run*/singles.root') or list of files, processed in sorted/given order
+    n_workers: number of processes (default: number of CPUs), 1 to process files sequentially
+    Other parameters: see process_file(), to_global must be picklable (e.g. a SimpleNamespace sensor)
+
+    Returns (clusters, cones) concatenated over files:
+     - EventIDs of each file are offset to stay unique
+     - ToAs of each file are offset if needed to follow the previous file (separated by more than window_ns)
+    """
+    stime = time.time()
+    global_log.info(f"Offline [batch]: START")
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    if not len(files):
+        global_log.error(f"No input file.")
+        global_log.info(f"Offline [batch]: {get_stop_string(stime)}")
+        return pd.DataFrame(), pd.DataFrame(columns=cones_columns)
+    global_log.debug(f"{len(files)} files")
+    if calib is not None and any(str(fp).endswith(('.t3pa', '.tpx3')) for fp in files):
+        calib = PixetCalibration.load(calib, chipID=chipID)  # parsed once, sent to the workers
+
+    args = dict(npix=npix, window_ns=window_ns, f=f, source_MeV=source_MeV, thickness_mm=thickness_mm,
+                charge_speed_mm_ns=charge_speed_mm_ns, to_global=to_global, calib=calib, chipID=chipID,
+                coinc_window_ns=coinc_window_ns, coinc_policy=coinc_policy, mask=mask)
+    if n_workers == 1:
+        results = [process_file(fp, **args) for fp in files]
+    else:
+        with ProcessPoolExecutor(n_workers) as ex:
+            futures = [ex.submit(_process_file_report, fp, **args) for fp in files]
+            results = []
+            for fut in futures:
+                clusters, cones, records = fut.result()
+                run_report.extend(records)
+                results.append((clusters, cones))
+
+    all_clusters, all_cones = [], []
+    evt_offset, toa_offset = 0, 0.
+    for clusters, cones in results:
+        n_evt, toa_end = 0, None
+        if clusters is not None and len(clusters):
+            clusters = clusters.copy()
+            if TOA in clusters.columns:
+                # shift only files overlapping the previous one (e.g. simulation runs starting at 0)
+                clusters[TOA] += max(0., toa_offset - clusters[TOA].min())
+                toa_end = clusters[TOA].max()
+            if EVENTID in clusters.columns:
+                n_evt = int(clusters[EVENTID].max()) + 1
+                clusters[EVENTID] += evt_offset
+            all_clusters.append(clusters)
+        if len(cones):
+            cones = cones.copy()
+            n_evt = max(n_evt, int(cones[EVENTID].max()) + 1)
+            cones[EVENTID] += evt_offset
+            all_cones.append(cones)
+        evt_offset += n_evt
+        if toa_end is not None:
+            toa_offset = toa_end + 10 * max(window_ns, coinc_window_ns or 0)  # no coincidence across files
+
+    clusters = pd.concat(all_clusters, ignore_index=True) if all_clusters else pd.DataFrame()
+    cones = pd.concat(all_cones, ignore_index=True) if all_cones else pd.DataFrame(columns=cones_columns)
+    global_log.info(f"Offline [batch]: {len(files)} files, {len(clusters)} clusters, {len(cones)} cones")
+    global_log_debug_df(cones)
+    global_log.info(f"Offline [batch]: {get_stop_string(stime)}")
+    return clusters, cones
@@ -0,0 +1,140 @@
+# Benchmarks of the offline pipeline stages on synthetic inputs
+# Each stage is timed at increasing scales, with throughput and peak memory (tracemalloc) recorded.
+# Results can be saved to CSV and compared to a previous run to catch regressions.
+
+import os
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from tools.analysis_pixelHits import pixet2pixelHit
+from tools.analysis_pixelClusters import pixelHits2pixelClusters
+from tools.analysis_cones import gHits2cones_byEvtID, pixelClusters2cones_byEvtID
+from tools.reco_backprojection import reco_bp
+from tools.point_source_validation import valid_psource
+from tools.synthetic import generate_interactions, interactions2pixelHits, interactions2pixelClusters, \
+    interactions2cones, interactions2gHits
+from tools.utils import charge_speed_mm_ns
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+BENCHMARK_BASELINE = 'benchmarks/baseline.csv'  # versioned reference run, results in output/ are not versioned
+benchmark_columns = ['stage', 'scale', 'n_in', 'n_out', 'time_s', 'rows_per_s', 'peak_MB']
+
+
+# ===========================
+# ==  SYNTHETIC INPUTS     ==
+# ===========================
+# Simulated data comes from tools/synthetic.py, measured data (Pixet) is faked below
+
+def bench_t3pa(dir_path, n_hits, npix=256, seed=1):
+    """
+    Pixet .t3pa file and text calibration files (caliba/b/c/t.txt) in dir_path
+    """
+    rng = np.random.default_rng(seed)
+    a, b, c, t = 1.6, 25., 300., 2.
+    for name, v in zip(['caliba', 'calibb', 'calibc', 'calibt'], [a, b, c, t]):
+        np.savetxt(os.path.join(dir_path, f'{name}.txt'), np.full((npix, npix), v) * rng.uniform(0.95, 1.05, (npix, npix)))
+    E = rng.uniform(t + 2 * c / b, 100, n_hits)  # ToT > 0, away from the pole of the surrogate function at E = t
+    df = pd.DataFrame({
+        'Index': np.arange(n_hits),
+        'Matrix Index': rng.integers(0, npix * npix, n_hits),
+        'ToA': np.sort(rng.integers(0, 2 ** 30, n_hits)),
+        'ToT': np.rint(a * E + b - c / (E - t)).astype(int),
+        'FToA': rng.integers(0, 16, n_hits),
+        'Overflow': np.zeros(n_hits, dtype=int),
+    })
+    t3pa_file = os.path.join(dir_path, 'bench.t3pa')
+    df.to_csv(t3pa_file, sep='\t', index=False)
+    return t3pa_file
+
+
+# ===========================
+# ==  MEASUREMENT          ==
+# ===========================
+
+def measure(stage, scale, func, *args, n_in=None, **kwargs):
+    """
+    Run func(*args, **kwargs) once and return its output and a benchmark record (see benchmark_columns)
+    """
+    tracemalloc.start()
+    stime = time.perf_counter()
+    out = func(*args, **kwargs)
+    duration = time.perf_counter() - stime
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    n_out = len(out) if hasattr(out, '__len__') else None
+    n_in = len(args[0]) if n_in is None and hasattr(args[0], '__len__') else n_in
+    record = dict(stage=stage, scale=scale, n_in=n_in, n_out=n_out, time_s=duration,
+                  rows_per_s=n_in / duration if n_in and duration else None, peak_MB=peak / 1e6)
+    global_log.info(f"Offline [benchmark]: {stage} scale {scale}: {duration:.3f} s, {peak / 1e6:.1f} MB")
+    return out, record
+
+
+def run_benchmarks(scales=(100, 1_000, 10_000), out_csv=None, npix=256, source_MeV=0.14, activity_Bq=1e6,
+                   vpitch=0.5, vsize=(32, 32, 32), max_reco_cones=200):
+    """
+    Time each pipeline stage at each scale.
+    Scale is the number of gammas emitted towards the sensor at activity_Bq (synthetic data),
+    or the number of hits in the .t3pa file.
+    Reconstruction stages are capped at max_reco_cones cones since they cost ~ vsize voxels per cone.
+    Returns a DataFrame with benchmark_columns, also saved to out_csv if given.
+    """
+    stime = time.time()
+    global_log.info(f"Offline [benchmark]: START")
+    records = []
+    spd = charge_speed_mm_ns(mobility_cm2_Vs=1000, bias_V=1000, thick_mm=1)
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            inter = generate_interactions(activity_Bq=activity_Bq, duration_s=scale / activity_Bq,
+                                          source_keV=source_MeV * 1e3, npix=npix, seed=1)
+            hits = interactions2pixelHits(inter, spd, npix=npix, seed=1)
+            records.append(measure('pixelHits2pixelClusters', scale, pixelHits2pixelClusters,
+                                   hits, npix=npix, window_ns=100, f='simu_calib')[1])
+
+            t3pa = bench_t3pa(tmp, scale, npix=npix)
+            records.append(measure('pixet2pixelHit', scale, pixet2pixelHit, t3pa, calib=tmp, n_in=scale)[1])
+
+            clusters = interactions2pixelClusters(inter, spd)
+            records.append(measure('pixelClusters2cones_byEvtID', scale, pixelClusters2cones_byEvtID,
+                                   clusters, source_MeV=source_MeV, thickness_mm=1, charge_speed_mm_ns=spd)[1])
+
+            ghits = interactions2gHits(inter, os.path.join(tmp, 'hits.root'))
+            records.append(measure('gHits2cones_byEvtID', scale, gHits2cones_byEvtID,
+                                   ghits, source_MeV, n_in=len(inter))[1])
+
+            cones = interactions2cones(inter, source_keV=source_MeV * 1e3)[:max_reco_cones]
+            records.append(measure('reco_bp', scale, reco_bp, cones, vpitch=vpitch, vsize=vsize)[1])
+            records.append(measure('valid_psource', scale, valid_psource, cones, src_pos=[0, 0, -5],
+                                   vpitch=vpitch, vsize=vsize, n_in=len(cones))[1])
+
+    df = pd.DataFrame(records, columns=benchmark_columns)
+    if out_csv:
+        df.to_csv(out_csv, index=False)
+    global_log.info(f"Offline [benchmark]: results\n{df.to_string(index=False)}")
+    global_log.info(f"Offline [benchmark]: STOP. Time: {time.time() - stime:.1f} seconds.\n" + '-' * 80)
+    return df
+
+
+def compare_benchmarks(results, baseline_csv=BENCHMARK_BASELINE, tolerance=0.25):
+    """
+    Compare results (DataFrame or CSV path) with a baseline CSV from a previous run_benchmarks()
+    (default BENCHMARK_BASELINE, copy a reference output/benchmark.csv there to update it).
+    Returns the rows (stage, scale) slower than (1 + tolerance) times the baseline, and logs them.
+    """
+    if isinstance(results, str):
+        results = pd.read_csv(results)
+    base = pd.read_csv(baseline_csv)
+    m = results.merge(base, on=['stage', 'scale'], suffixes=('', '_baseline'))
+    m['ratio'] = m['time_s'] / m['time_s_baseline']
+    regressions = m[m['ratio'] > 1 + tolerance][['stage', 'scale', 'time_s', 'time_s_baseline', 'ratio',
+                                                  'peak_MB', 'peak_MB_baseline']]
+    for _, r in regressions.iterrows():
+        global_log.warning(f"Regression: {r['stage']} scale {r['scale']} is {r['ratio']:.2f}x slower than baseline")
+    return regressions
@@ -0,0 +1,273 @@
+# Pixet ToT -> energy calibration, parsed once and reused
+# Per-pixel surrogate function (Jakubek et al.): ToT = a * E + b - c / (E - t)
+# The calibration set of a chip comes from:
+#  - a directory with caliba.txt, calibb.txt, calibc.txt, calibt.txt (Pixet: Detector Setting -> More Detector
+#    Settings -> Chips -> Save)
+#  - an XML file with the calibration of several chips, provided with the detector
+# It is parsed once, validated, saved as .npz next to its sources (reused while newer than them), and cached in memory
+# by path and modification time, e.g. for batch jobs processing many files of the same chip.
+#
+# ToT is an integer counter with a limited range: build_lut() precomputes the energy of every ToT value
+# (per pixel, float32), energy(..., lut=lut) then becomes a single gather. ToT values outside the table use the formula.
+# The LUT is returned, not stored in the (shared, cached) calibration: it is only used where it is passed, and freed
+# with its last reference.
+# Allpix2 pixel hits go through the same ToTCalibration interface (LinearCalibration, one factor for all pixels),
+# without LUT: their ToT is a charge in electrons (large range), and a product is as fast as a gather.
+#
+# Example:
+#   calib = PixetCalibration.load('./minipix/')
+#   lut = calib.build_lut()  # optional LUT, 256 MB for 65536 pixels x 1024 ToT, reused for all the files
+#   pixelHits = [pixet2pixelHit(f, calib, lut=lut) for f in files_t3pa]
+#   del lut
+
+import os
+import abc
+import time
+import base64
+import xml.etree.ElementTree as ET
+import numpy as np
+from tools.utils import get_stop_string
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+CALIB_NAMES = ['caliba', 'calibb', 'calibc', 'calibt']
+CALIB_NPZ = 'calib.npz'  # parsed calibration, in the calibration directory
+_calib_cache = {}  # (path, chipID, mtime) -> PixetCalibration
+
+
+class ToTCalibration(abc.ABC):
+    """
+    ToT -> energy (keV) per pixel, from _energy()
+    n_rows: number of pixel calibrations, 1 if the calibration is the same for all pixels
+    """
+    n_rows = 1
+
+    @abc.abstractmethod
+    def _energy(self, tot, pixel_id):
+        pass
+
+    @abc.abstractmethod
+    def tot(self, energy, pixel_id=0):
+        """
+        ToT (float) of hits from their energy (keV), inverse of energy(), e.g. to export calibrated hits
+        """
+
+    def _rows(self, tot, pixel_id):
+        return np.broadcast_to(np.asarray(pixel_id, dtype=np.int64) if self.n_rows > 1 else 0, tot.shape)
+
+    def energy(self, tot, pixel_id=0):
+        """
+        Energy (keV) of hits from their ToT and pixel index (Matrix Index / PixelID)
+        """
+        tot = np.asarray(tot)
+        return self._energy(tot.astype(float), self._rows(tot, pixel_id))
+
+
+class LinearCalibration(ToTCalibration):
+    """
+    Energy proportional to ToT, same for all pixels (e.g. Allpix2 DefaultDigitizer, ToT in electrons)
+    """
+
+    def __init__(self, keV_per_ToT=4.43 / 1000):
+        self.keV_per_ToT = keV_per_ToT
+
+    def _energy(self, tot, pixel_id):
+        return tot * self.keV_per_ToT
+
+    def tot(self, energy, pixel_id=0):
+        return np.asarray(energy, dtype=float) / self.keV_per_ToT
+
+
+class PixetCalibration(ToTCalibration):
+    """
+    Calibration coefficients a, b, c, t per pixel (flattened in Matrix Index order), with derived coefficients
+    of the inverse of the surrogate function:
+        u = b - a * t,  p = 2 * b + 2 * a * t,  q = u^2 + 4 * a * (t * b + c)
+        E = (ToT - u + sqrt(ToT^2 - p * ToT + q)) / (2 * a)
+    """
+
+    def __init__(self, a, b, c, t, chipID=None, path=None, n_pixels=256):
+        coefs = [np.asarray(v, dtype=float).ravel() for v in (a, b, c, t)]
+        for name, v in zip(CALIB_NAMES, coefs):
+            if v.shape != (n_pixels * n_pixels,):
+                raise ValueError(f"{name}: {v.size} values, expected {n_pixels}x{n_pixels}")
+        self.a, self.b, self.c, self.t = coefs
+        self.chipID = chipID
+        self.path = path
+        self.n_pixels = n_pixels
+
+        self.u = self.b - self.a * self.t
+        self.p = 2 * self.b + 2 * self.a * self.t
+        self.q = self.u ** 2 + 4 * self.a * (self.t * self.b + self.c)
+        with np.errstate(divide='ignore'):
+            self.inv_2a = np.where(self.a != 0, 0.5 / self.a, np.nan)  # a = 0 => no solution (NaN)
+
+    @property
+    def n_rows(self):
+        return self.a.size
+
+    @property
+    def directory(self):
+        """
+        Directory of the calibration sources (also for XML and .npz files), e.g. for its PIXEL_MASK_FILE
+        """
+        if self.path is None:
+            raise ValueError("Calibration not loaded from files, no directory")
+        return self.path if os.path.isdir(self.path) else os.path.dirname(os.path.abspath(self.path))
+
+    def _energy(self, tot, i):
+        # NaN if the quadratic has no solution
+        disc = tot * (tot - self.p[i]) + self.q[i]
+        with np.errstate(invalid='ignore'):
+            return (tot - self.u[i] + np.sqrt(disc)) * self.inv_2a[i]
+
+    def tot(self, energy, pixel_id=0):
+        E = np.asarray(energy, dtype=float)
+        i = np.asarray(pixel_id, dtype=np.int64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.a[i] * E + self.b[i] - self.c[i] / (E - self.t[i])
+
+    # ===========================
+    # ==  LOOKUP TABLE         ==
+    # ===========================
+
+    def build_lut(self, max_ToT=1024, rows_per_block=4096):
+        """
+        Energy of ToT = 0 ... max_ToT - 1 for each pixel, float32 array (n_rows, max_ToT), to pass to energy()
+        Not kept by the calibration: reuse it for many files, delete it to free the memory.
+        """
+        stime = time.time()
+        tot = np.arange(max_ToT, dtype=float)
+        lut = np.empty((self.n_rows, max_ToT), dtype=np.float32)
+        for i in range(0, self.n_rows, rows_per_block):  # blocks: limits float64 temporaries
+            rows = np.arange(i, min(i + rows_per_block, self.n_rows))
+            lut[rows] = self._energy(tot[None, :], rows[:, None])
+        global_log.debug(f"ToT LUT {lut.shape} ({lut.nbytes / 1e6:.0f} MB), {get_stop_string(stime)}")
+        return lut
+
+    def energy(self, tot, pixel_id=0, lut=None):
+        """
+        Energy (keV) of hits from their ToT and pixel index (Matrix Index)
+        lut: table from build_lut(), gather for integer ToT within the table, formula for the others
+        """
+        if lut is None or lut is False:
+            return super().energy(tot, pixel_id)
+        if lut.shape[0] != self.n_rows:
+            raise ValueError(f"LUT for {lut.shape[0]} pixels, calibration for {self.n_rows}")
+        tot = np.asarray(tot)
+        i = self._rows(tot, pixel_id)
+        t = tot.astype(np.int64) if tot.dtype.kind in 'iu' else np.floor(tot).astype(np.int64)
+        inside = (t >= 0) & (t < lut.shape[1])
+        if tot.dtype.kind not in 'iu':
+            inside &= (t == tot)
+        E = lut[i, np.where(inside, t, 0)].astype(float)
+        if not inside.all():
+            E[~inside] = self._energy(tot[~inside].astype(float), i[~inside])
+        return E
+
+    # ===========================
+    # ==  LOADING              ==
+    # ===========================
+
+    @classmethod
+    def load(cls, calib, chipID=None):
+        """
+        calib: calibration directory, XML file, or .npz saved by save()
+        chipID: checked against the chip of the calibration, recorded in the .npz of a directory calibration
+                the first time it is given (later loads with another chipID raise a ValueError)
+        Parsed text/XML sources are saved as .npz (CALIB_NPZ in the directory, <xml>.<chipID>.npz next to the XML)
+        Cached in memory until the sources are modified.
+        """
+        if isinstance(calib, cls):
+            if chipID is not None and calib.chipID is not None and calib.chipID != chipID:
+                raise ValueError(f"Calibration is for chip {calib.chipID}, not {chipID}")
+            return calib
+        calib = str(calib)
+        sources, npz_path = _calib_files(calib, chipID)
+        key = (os.path.abspath(calib), chipID, max(os.path.getmtime(f) for f in sources))
+        if key in _calib_cache:
+            return _calib_cache[key]
+
+        stime = time.time()
+        if npz_path and os.path.isfile(npz_path) and os.path.getmtime(npz_path) >= key[2]:
+            obj = cls.from_npz(npz_path, path=calib)
+        elif calib.endswith('.npz'):
+            obj = cls.from_npz(calib)
+        elif calib.endswith('xml'):
+            obj = cls.from_xml(calib, chipID)
+        else:
+            obj = cls.from_dir(calib)
+        if chipID is not None and obj.chipID is not None and obj.chipID != chipID:
+            raise ValueError(f"{calib}: calibration is for chip {obj.chipID}, not {chipID}")
+        new_chipID = chipID is not None and obj.chipID is None
+        if new_chipID:
+            obj.chipID = chipID
+        if npz_path and (new_chipID or not os.path.isfile(npz_path) or os.path.getmtime(npz_path) < key[2]):
+            try:
+                obj.save(npz_path)
+            except OSError as e:
+                global_log.debug(f"Calibration not saved in {npz_path}: {e}")
+        for name in CALIB_NAMES:
+            global_log.debug(f"Mean of {name}: {np.mean(getattr(obj, name[-1]))}")
+        global_log.debug(f"Calibration {calib} loaded, {get_stop_string(stime)}")
+        _calib_cache[key] = obj
+        return obj
+
+    @classmethod
+    def from_dir(cls, dir_path):
+        global_log.info(f"Offline [pixelHits]: Searching {dir_path} for calib files")
+        arrays = []
+        for name in CALIB_NAMES:
+            file_path = os.path.join(dir_path, f"{name}.txt")
+            arr = np.loadtxt(file_path)
+            if arr.ndim != 2 or arr.shape[0] != arr.shape[1]:
+                raise ValueError(f"{file_path} does not have shape (n, n), got {arr.shape}")
+            arrays.append(arr.flatten())  # row-major order
+        return cls(*arrays, path=dir_path, n_pixels=int(np.sqrt(arrays[0].size)))
+
+    @classmethod
+    def from_xml(cls, xml_path, chipID):
+        global_log.info(f"Offline [pixelHits]: Using XML file for calibration")
+        global_log.error("Reading calibration from XML seems wrong with current decoding")
+        root = ET.parse(xml_path).getroot()
+        chip = root.find(chipID) if chipID else None
+        if chip is None:
+            raise ValueError(f"Chip {chipID} not found in XML file {xml_path}")
+        arrays = []
+        for name in CALIB_NAMES:
+            calib_str = chip.find(name).text
+            if calib_str is None:
+                raise ValueError(f"No {name} for chip {chipID} in {xml_path}")
+            arr = np.frombuffer(base64.b64decode(calib_str), dtype=np.float32)
+            arrays.append(arr[1::2])
+        return cls(*arrays, chipID=chipID, path=xml_path, n_pixels=int(np.sqrt(arrays[0].size)))
+
+    @classmethod
+    def from_npz(cls, npz_path, path=None):
+        with np.load(npz_path) as f:
+            chipID = str(f['chipID']) if f['chipID'].size else None
+            return cls(f['a'], f['b'], f['c'], f['t'], chipID=chipID, path=path or npz_path,
+                       n_pixels=int(f['n_pixels']))
+
+    def save(self, npz_path):
+        np.savez(npz_path, a=self.a, b=self.b, c=self.c, t=self.t, n_pixels=self.n_pixels,
+                 chipID=np.array(self.chipID if self.chipID is not None else [], dtype=str))
+        return npz_path
+
+
+def _calib_files(calib, chipID):
+    """
+    Source files of a calibration and the path of its .npz (None if calib is already a .npz)
+    """
+    if calib.endswith('.npz'):
+        return [calib], None
+    if calib.endswith('xml'):
+        return [calib], f"{calib}.{chipID}.npz"
+    if not os.path.isdir(calib):
+        raise FileNotFoundError(f"Calibration {calib} not found")
+    return [os.path.join(calib, f"{name}.txt") for name in CALIB_NAMES], os.path.join(calib, CALIB_NPZ)
@@ -0,0 +1,95 @@
+# Compton cone physics, vectorized over cones
+# E0 = source energy, E1 = energy deposited in the Compton scattering (as in CCMod paper), in keV
+# The cone 'error' is the uncertainty on cosT, propagated from:
+#  - energy resolution (E0 known, E1 measured): d(cosT)/dE1 = -me / (E0 - E1)^2
+#  - position resolution of both interactions, over the lever arm between them: d(theta) = sqrt(2) * sigma / lever
+# Reconstruction can use it as the width of each cone (e.g. reco_bp(..., tolerance=None)).
+
+import functools
+import numpy as np
+
+ELECTRON_MASS_keV = 511.
+
+# Main gamma lines of radioisotopes in keV, e.g. for cone building with several source energies (source_MeV as list)
+emission_lines_keV = {
+    'Tc99m': [140.51],
+    'Lu177': [112.95, 208.37],
+    'U238': [49.55],  # U238 decay only, i.e. without the decay chain
+    'U238_chain': [49.55, 63.29, 92.38, 92.80, 186.21, 242.00, 295.22, 351.93, 609.31, 1001.03, 1120.29,
+                   1764.49],  # Th234, Ra226, Pb214, Bi214, Pa234m
+}
+
+
+def get_E1max_keV(E0_keV):
+    """
+    Compton edge: maximum energy deposited in a Compton scattering
+    """
+    return E0_keV ** 2 / (E0_keV + ELECTRON_MASS_keV / 2)
+
+
+@functools.lru_cache(maxsize=64)
+def compton_table(E0_keV, n_E1=4096):
+    """
+    cosT and d(cosT)/dE1 on a regular E1 grid from 0 to the Compton edge, computed once per source energy
+    """
+    E1 = np.linspace(0, get_E1max_keV(E0_keV), n_E1)
+    cosT = 1 - ELECTRON_MASS_keV * E1 / (E0_keV * (E0_keV - E1))
+    dcosT = -ELECTRON_MASS_keV / (E0_keV - E1) ** 2
+    for a in (E1, cosT, dcosT):
+        a.flags.writeable = False  # shared between calls
+    return E1, cosT, dcosT
+
+
+def compton_cosT(E0_keV, E1_keV, table=False):
+    """
+    cos of the Compton scattering angle, from source energy and energy deposited
+    table: interpolate in compton_table() instead of computing the formula (E0_keV must be a scalar)
+    E1 above the Compton edge gives cosT < -1 (not a Compton event)
+    """
+    E1_keV = np.asarray(E1_keV, dtype=float)
+    if table:
+        E1, cosT, _ = compton_table(float(E0_keV))
+        return np.where(E1_keV <= E1[-1], np.interp(E1_keV, E1, cosT), -np.inf)
+    return 1 - ELECTRON_MASS_keV * E1_keV / (E0_keV * (E0_keV - E1_keV))
+
+
+def compton_cosT_error(E0_keV, E1_keV, sigma_E_keV=0., sigma_pos_mm=0., lever_mm=None):
+    """
+    Uncertainty on cosT from the energy resolution (sigma of E1) and the position resolution (sigma of each
+    interaction position, in mm) over lever_mm, the distance between the two interactions.
+    sigma_E_keV, sigma_pos_mm and lever_mm can be scalars or arrays (one value per cone).
+    """
+    E1_keV = np.asarray(E1_keV, dtype=float)
+    var = (ELECTRON_MASS_keV * np.asarray(sigma_E_keV) / (E0_keV - E1_keV) ** 2) ** 2
+    if lever_mm is not None:
+        sinT = np.sqrt(np.clip(1 - compton_cosT(E0_keV, E1_keV) ** 2, 0, 1))
+        var = var + (sinT * np.sqrt(2) * np.asarray(sigma_pos_mm) / np.asarray(lever_mm)) ** 2
+    return np.sqrt(var)
+
+
+def source_lines_keV(source_MeV):
+    """
+    Sorted source energies in keV, from one energy or a list of emission lines in MeV
+    """
+    return np.sort(np.atleast_1d(np.asarray(source_MeV, dtype=float))) * 1e3
+
+
+def nearest_line(E_keV, lines_keV):
+    """
+    Index of the nearest line (lines_keV sorted) and distance to it, for each energy
+    """
+    E_keV = np.asarray(E_keV, dtype=float)
+    i = np.searchsorted(lines_keV, E_keV)
+    lo, hi = np.clip(i - 1, 0, len(lines_keV) - 1), np.clip(i, 0, len(lines_keV) - 1)
+    idx = np.where(np.abs(E_keV - lines_keV[lo]) <= np.abs(E_keV - lines_keV[hi]), lo, hi)
+    return idx, np.abs(E_keV - lines_keV[idx])
+
+
+def assign_lines(E_keV, lines_keV, window_keV):
+    """
+    Index of the nearest line (lines_keV sorted) for each energy, -1 if further than window_keV
+    window_keV: scalar, or one value per line
+    """
+    idx, dist = nearest_line(E_keV, lines_keV)
+    window_keV = np.broadcast_to(np.asarray(window_keV, dtype=float), np.shape(lines_keV))
+    return np.where(dist <= window_keV[idx], idx, -1)
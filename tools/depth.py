@@ -0,0 +1,108 @@
+# Depth of interaction (absolute z) of clusters from their size and ToA spread
+# Charges created far from the readout drift longer => larger clusters (diffusion) and larger ToA spread.
+# The mean true depth in bins of (size, ToA spread) is tabulated once per sensor (bias, thickness, threshold...)
+# from simulated clusters with known depth (Allpix2 runs, tools/synthetic.py...), saved as .npz and used as lookup table.
+#
+# Example:
+#   clusters = pixelHits2pixelClusters(hits, npix, window_ns=100, f='simu_calib', features=True)
+#   lut = build_depth_lut(clusters, clusters_true_depth(clusters, interactions))
+#   save_depth_lut('calib/depth_lut.npz', lut)
+#   ...
+#   clusters = estimate_depth(clusters, load_depth_lut('calib/depth_lut.npz'))  # adds PIX_Z_ID
+#
+# z is in local fractional coordinates (see analysis_pixelClusters): -0.5 to 0.5, pointing towards the readout.
+
+import os
+import time
+import numpy as np
+from tools.analysis_pixelHits import PIX_X_ID, PIX_Y_ID, PIX_Z_ID, EVENTID
+from tools.analysis_pixelClusters import CLUSTER_SIZE, TOA_SPREAD
+from tools.utils import get_stop_string
+from tools.utils_profiling import instrument
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+_lut_cache = {}  # (path, mtime) -> lut
+
+
+def clusters_true_depth(clusters, interactions):
+    """
+    True z of each cluster, from the interaction of the same event closest in (x, y)
+    interactions: DataFrame with EventID and local fractional X/Y/Z (e.g. from synthetic.generate_interactions)
+    """
+    c = clusters[[EVENTID, PIX_X_ID, PIX_Y_ID]].reset_index(drop=True).reset_index()
+    m = c.merge(interactions[[EVENTID, PIX_X_ID, PIX_Y_ID, PIX_Z_ID]], on=EVENTID, suffixes=('', '_true'))
+    m['d2'] = (m[PIX_X_ID] - m[PIX_X_ID + '_true']) ** 2 + (m[PIX_Y_ID] - m[PIX_Y_ID + '_true']) ** 2
+    best = m.loc[m.groupby('index')['d2'].idxmin()]
+    z = np.full(len(clusters), np.nan)
+    z[best['index'].to_numpy()] = best[PIX_Z_ID].to_numpy()
+    return z
+
+
+def build_depth_lut(clusters, true_z, max_size=20, spread_edges_ns=np.arange(0, 51, 1.5625)):
+    """
+    Mean true z in bins of cluster size (1 to max_size, larger sizes go in the last bin) and ToA spread.
+    clusters: from pixelHits2pixelClusters(..., features=True)
+    Empty bins take the mean of their size row, or the overall mean.
+    Returns a dict with z (n_size, n_spread), counts, spread_edges_ns and max_size.
+    """
+    true_z = np.asarray(true_z, dtype=float)
+    ok = ~np.isnan(true_z)
+    i, j = _lut_indices(clusters[ok], max_size, spread_edges_ns)
+    shape = (max_size, len(spread_edges_ns) - 1)
+    flat = np.ravel_multi_index((i, j), shape)
+    counts = np.bincount(flat, minlength=shape[0] * shape[1]).reshape(shape)
+    sums = np.bincount(flat, true_z[ok], minlength=shape[0] * shape[1]).reshape(shape)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = sums / counts
+        row = sums.sum(axis=1) / counts.sum(axis=1)
+    z = np.where(counts > 0, z, row[:, None])
+    z = np.where(np.isnan(z), true_z[ok].mean(), z)
+    global_log.debug(f"Depth LUT from {ok.sum()} clusters, {np.count_nonzero(counts)}/{counts.size} bins filled")
+    return dict(z=z, counts=counts, spread_edges_ns=np.asarray(spread_edges_ns, dtype=float), max_size=max_size)
+
+
+def save_depth_lut(file_path, lut):
+    np.savez(file_path, **lut)
+
+
+def load_depth_lut(file_path):
+    """
+    Load a LUT saved with save_depth_lut(), cached until the file is modified
+    """
+    key = (os.path.abspath(file_path), os.path.getmtime(file_path))
+    if key not in _lut_cache:
+        with np.load(file_path) as f:
+            _lut_cache[key] = dict(z=f['z'], counts=f['counts'], spread_edges_ns=f['spread_edges_ns'],
+                                   max_size=int(f['max_size']))
+    return _lut_cache[key]
+
+
+def _lut_indices(clusters, max_size, spread_edges_ns):
+    if CLUSTER_SIZE not in clusters.columns or TOA_SPREAD not in clusters.columns:
+        raise ValueError(f"Clusters need '{CLUSTER_SIZE}' and '{TOA_SPREAD}', use pixelHits2pixelClusters(..., features=True)")
+    i = np.clip(clusters[CLUSTER_SIZE].to_numpy(dtype=int), 1, max_size) - 1
+    j = np.searchsorted(spread_edges_ns, clusters[TOA_SPREAD].to_numpy(), side='right') - 1
+    return i, np.clip(j, 0, len(spread_edges_ns) - 2)
+
+
+@instrument('depth')
+def estimate_depth(clusters, lut):
+    """
+    Returns a copy of clusters with PIX_Z_ID (local fractional z) from the depth LUT (dict or .npz path)
+    """
+    stime = time.time()
+    global_log.info(f"Offline [depth]: START")
+    if isinstance(lut, (str, os.PathLike)):
+        lut = load_depth_lut(lut)
+    clusters = clusters.copy()
+    i, j = _lut_indices(clusters, lut['max_size'], lut['spread_edges_ns'])
+    clusters[PIX_Z_ID] = lut['z'][i, j]
+    global_log.info(f"Offline [depth]: {get_stop_string(stime)}")
+    return clusters
@@ -1,25 +1,143 @@
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
 import uproot
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QPushButton, QWidget, QHBoxLayout,
-    QTableWidget, QTableWidgetItem, QSplitter
+    QTableView, QHeaderView, QSplitter
 )
 from PyQt5.QtWebEngineWidgets import QWebEngineView
 import plotly.express as px
+from plotly.offline import get_plotlyjs
 import os  # For working with file paths
-from PyQt5.QtCore import QUrl  # For handling URLs
-from PyQt5.QtGui import QColor  # Import for setting background color
+from PyQt5.QtCore import QUrl, Qt, QAbstractTableModel, QModelIndex  # For handling URLs, table model
+from PyQt5.QtGui import QColor, QBrush  # Import for setting background color
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # run from tools/ or the repo root
+from tools.utils import read_hits
+
+
+class HitsEvents:
+    """
+    Events of a hits DataFrame or ROOT file, accessed by position (0 to len-1) without scanning all hits.
+    The index (EventIDs sorted, offsets from searchsorted) is built once:
+     - DataFrame: hits sorted by EventID, an event is a slice
+     - ROOT file: only EventID is read, events are paged lazily with entry_start/entry_stop
+       (the entry range of each event, filtered by EventID if events are interleaved, e.g. multi-threaded Gate)
+    transform: function applied to each event DataFrame (e.g. unit conversions)
+    cache_size: number of events kept in memory (least recently used are dropped)
+    """
+
+    def __init__(self, source, transform=None, cache_size=64):
+        self.transform = transform
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()  # events can be loaded from a background thread
+        if isinstance(source, pd.DataFrame):
+            self.file_path = None
+            eid = source['EventID'].to_numpy()
+            order = np.argsort(eid, kind='stable')
+            self.df = source.iloc[order].reset_index(drop=True)
+            self.event_ids, starts = np.unique(eid[order], return_index=True)
+            self.offsets = np.r_[starts, len(eid)]
+        else:
+            self.file_path = str(source)
+            with uproot.open(self.file_path) as f:
+                eid = f['Hits']['EventID'].array(library='np')
+            order = np.argsort(eid, kind='stable')
+            eid_sorted = eid[order]
+            self.event_ids = np.unique(eid_sorted)
+            lo = np.searchsorted(eid_sorted, self.event_ids, side='left')
+            self.entry_start = np.minimum.reduceat(order, lo)
+            self.entry_stop = np.maximum.reduceat(order, lo) + 1
+
+    def __len__(self):
+        return len(self.event_ids)
+
+    def __getitem__(self, i):
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+        event = self._load(i)
+        with self._lock:
+            self._cache[i] = event
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return event
+
+    def _load(self, i):
+        if self.file_path is None:
+            event = self.df.iloc[self.offsets[i]:self.offsets[i + 1]].copy()
+        else:
+            event = read_hits(self.file_path, entry_start=int(self.entry_start[i]), entry_stop=int(self.entry_stop[i]))
+            event = event[event['EventID'] == self.event_ids[i]].reset_index(drop=True)
+        return self.transform(event) if self.transform else event
+
+
+class EventTableModel(QAbstractTableModel):
+    """
+    Table model backed by the NumPy columns of one event.
+    Cells are formatted in data() only when the view displays them, so updates cost O(visible rows).
+    Gamma rows are highlighted.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.columns, self.arrays = [], []
+        self.n_rows = 0
+        self.gamma = np.zeros(0, dtype=bool)
+        self.highlight = QBrush(QColor('yellow'))
+
+    def set_event(self, event_data):
+        self.beginResetModel()
+        self.columns = list(event_data.columns)
+        self.arrays = [event_data[c].to_numpy() for c in self.columns]
+        self.n_rows = len(event_data)
+        if 'ParticleName' in event_data.columns:
+            self.gamma = (event_data['ParticleName'] == 'gamma').to_numpy()
+        else:
+            self.gamma = np.zeros(self.n_rows, dtype=bool)
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.n_rows
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.DisplayRole:
+            value = self.arrays[index.column()][index.row()]
+            return str(round(float(value), 3)) if isinstance(value, (float, np.floating)) else str(value)
+        if role == Qt.BackgroundRole and self.gamma[index.row()]:
+            return self.highlight
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        return self.columns[section] if orientation == Qt.Horizontal else str(section)
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, df):
+    def __init__(self, events):
+        """
+        events: HitsEvents, or hits DataFrame
+        """
         super().__init__()
-        self.df = df
-        self.event_ids = df['EventID'].unique()
+        self.events = events if isinstance(events, HitsEvents) else HitsEvents(events)
+        self.event_ids = self.events.event_ids
         self.current_event_index = 0
         self.table_visible = True
-        self.removed_points = []  # Store removed points information
+        self.page_ready = False  # plot page loaded, see init_plot_page()
+        self.figures = {}  # event index -> Future of the figure JSON (rendered in background)
+        self.executor = ThreadPoolExecutor(max_workers=1)
 
         self.initUI()
 
@@ -42,9 +160,13 @@ class MainWindow(QMainWindow):
         self.web_view = QWebEngineView()
         plot_layout.addWidget(self.web_view)
         self.splitter.addWidget(plot_widget)
+        self.init_plot_page()
 
-        # Right side: Table for event data
-        self.table_display = QTableWidget()
+        # Right side: Table for event data (only visible rows are rendered)
+        self.table_model = EventTableModel(self)
+        self.table_display = QTableView()
+        self.table_display.setModel(self.table_model)
+        self.table_display.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         self.table_display.setMinimumWidth(1000)
         self.splitter.addWidget(self.table_display)
 
@@ -70,7 +192,31 @@ class MainWindow(QMainWindow):
         self.plot_event()
         self.update_event_table()
 
-    def create_plotly_figure(self, event_data):
+    def init_plot_page(self):
+        """
+        Load an empty Plotly page once, with plotly.js bundled (works offline).
+        Events are then drawn in place with Plotly.react (see plot_event).
+        The page is loaded from a file since setHtml() is limited to 2 MB.
+        """
+        html = (f"<html><head><meta charset='utf-8'><script type='text/javascript'>{get_plotlyjs()}</script></head>"
+                f"<body style='margin:0'><div id='plot' style='width:100%;height:100vh'></div></body></html>")
+        with tempfile.NamedTemporaryFile('w', suffix='.html', delete=False, encoding='utf-8') as f:
+            f.write(html)  # one file per viewer, removed in closeEvent()
+        self.page_path = f.name
+        self.web_view.loadFinished.connect(self.on_page_loaded)
+        self.web_view.load(QUrl.fromLocalFile(self.page_path))
+
+    def closeEvent(self, event):
+        self.executor.shutdown(wait=False)
+        if os.path.isfile(self.page_path):
+            os.remove(self.page_path)
+        super().closeEvent(event)
+
+    def on_page_loaded(self, ok):
+        self.page_ready = ok
+        self.plot_event()
+
+    def create_plotly_figure(self, event_data, event_id):
         """Creates a Plotly 3D scatter plot for the event data with equalized axis ranges."""
         # Extract positions and other data
         x = event_data['Position_X']
@@ -107,7 +253,7 @@ class MainWindow(QMainWindow):
             y='Position_Y',
             z='Position_Z',
             color=colors,
-            title=f"Event ID: {self.event_ids[self.current_event_index]}",
+            title=f"Event ID: {event_id}",
             labels={'Position_X': 'X Position (um)', 'Position_Y': 'Y Position (um)', 'Position_Z': 'Z Position (um)'},
             text=text_labels  # This adds the `TrackID` as annotations for points with PDGEncoding == 22
         )
@@ -124,45 +270,41 @@ class MainWindow(QMainWindow):
         return fig
 
     def plot_event(self):
-        """Render the 3D Plotly plot for the current EventID with PDGEncoding color mapping."""
-        # Get current event data
-        current_event_id = self.event_ids[self.current_event_index]
-        event_data = self.df[self.df['EventID'] == current_event_id]
+        """Update the 3D Plotly plot with the current EventID, and pre-render the neighbouring events."""
+        if not self.page_ready:
+            return  # plotted when the page is loaded
+        fig_json = self.figure_json(self.current_event_index).result()
+        self.web_view.page().runJavaScript(f"var fig = {fig_json}; Plotly.react('plot', fig.data, fig.layout);")
+
+        # Pre-render next/previous events in the background, forget the others
+        i = self.current_event_index
+        neighbours = [j for j in (i + 1, i - 1, i + 2) if 0 <= j < len(self.event_ids)]
+        for j in neighbours:
+            self.figure_json(j)
+        for j in [j for j in self.figures if abs(j - i) > 2]:
+            del self.figures[j]
+
+    def figure_json(self, i):
+        """Future of the figure JSON of event i, rendered in the background thread"""
+        if i not in self.figures:
+            self.figures[i] = self.executor.submit(self.render_event, i)
+        return self.figures[i]
+
+    def render_event(self, i):
+        """Plotly figure (JSON) of event i, with PDGEncoding color mapping."""
+        event_data = self.events[i].copy()
 
         event_data['Position_X'] = pd.to_numeric(event_data['Position_X'], errors='coerce')
         event_data['Position_Y'] = pd.to_numeric(event_data['Position_Y'], errors='coerce')
         event_data['Position_Z'] = pd.to_numeric(event_data['Position_Z'], errors='coerce')
         event_data['ParticleName'] = event_data['ParticleName'].astype(str)  # Ensure names are strings
 
-        # Remove points that were deleted in the current event
-        if self.removed_points:
-            event_data = event_data[
-                ~event_data.apply(
-                    lambda row: (
-                                    row['Position_X'],
-                                    row['Position_Y'],
-                                    row['Position_Z']
-                                ) in self.removed_points,
-                    axis=1,
-                )
-            ]
-
-        # Create the Plotly figure
-        fig = self.create_plotly_figure(event_data)
-
-        # Get the figure as an HTML string
-        plot_html = self.create_plotly_figure(event_data).to_html(include_plotlyjs='cdn')
-
-        # Load the HTML string in QWebEngineView
-        self.web_view.setHtml(plot_html)
+        return self.create_plotly_figure(event_data, self.event_ids[i]).to_json()
 
     def update_event_table(self):
-        """Displays rows corresponding to the current event in a table widget."""
-        self.table_display.clear()
-
+        """Displays rows corresponding to the current event in the table view."""
         # Get current event's data
-        current_event_id = self.event_ids[self.current_event_index]
-        event_data = self.df[self.df['EventID'] == current_event_id]
+        event_data = self.events[self.current_event_index]
 
         # Drop unnecessary columns
         columns_to_drop = [
@@ -173,22 +315,7 @@ class MainWindow(QMainWindow):
         ]
         cleaned_event_data = event_data.drop(columns=columns_to_drop, errors='ignore')
 
-        # Update table structure
-        self.table_display.setColumnCount(len(cleaned_event_data.columns))
-        self.table_display.setRowCount(len(cleaned_event_data.index))
-        self.table_display.setHorizontalHeaderLabels(cleaned_event_data.columns)
-
-        # Populate table with data and highlight rows with PDGEncoding == 22
-        for i, (index, row) in enumerate(cleaned_event_data.iterrows()):
-            for j, value in enumerate(row):
-                value = round(value, 3) if isinstance(value, float) else value
-                item = QTableWidgetItem(str(value))
-
-                # Highlight row if PDGEncoding == 22
-                if row['ParticleName'] == 'gamma':
-                    item.setBackground(QColor('yellow'))  # Set the background color to yellow
-
-                self.table_display.setItem(i, j, item)
+        self.table_model.set_event(cleaned_event_data)
 
     def next_event(self):
         """Go to the next event."""
@@ -214,28 +341,27 @@ class MainWindow(QMainWindow):
 
     def print_event_data(self):
         """Print the DataFrame rows corresponding to the currently displayed event."""
-        current_event_id = self.event_ids[self.current_event_index]
-        event_data = self.df[self.df['EventID'] == current_event_id]
-        print(event_data)
+        print(self.events[self.current_event_index])
 
 
-# Load ROOT file and initialize GUI
-def main():
-    # Read the ROOT file into a DataFrame
-    file_path = "../output/"
-    tree = uproot.open(file_path + "CC_Hits.root:Hits")
-    df = tree.arrays(library="pd")
-
-    # Unit conversions
+def to_keV_um(df):
+    """Unit conversions of an event"""
     df['KineticEnergy'] *= 1000  # To keV
     df['TotalEnergyDeposit'] *= 1000  # To keV
     df['Position_X'] *= 1000  # To micrometers (um)
     df['Position_Y'] *= 1000  # To micrometers (um)
     df['Position_Z'] *= 1000  # To micrometers (um)
+    return df
+
+
+# Index ROOT file and initialize GUI (events are read when displayed)
+def main():
+    file_path = "../output/"
+    events = HitsEvents(file_path + "CC_Hits.root", transform=to_keV_um)
 
     # Launch PyQt5 app
     app = QApplication(sys.argv)
-    main_window = MainWindow(df)
+    main_window = MainWindow(events)
     main_window.show()
     sys.exit(app.exec_())
 
@@ -0,0 +1,184 @@
+# Detector monitoring for long acquisitions
+# Count, energy-sum and ToT maps and energy/ToT spectra, accumulated from streamed pixel hits chunks
+# (each update is O(chunk): bincount into preallocated arrays, the data is never re-read).
+# Snapshots are saved periodically as .npz, to follow detector health and hot pixels during the acquisition.
+#
+# Example:
+#   mon = PixelHitsMonitor(256, snapshot_path='output/monitor.npz', snapshot_every_s=30)
+#   for chunk in chunks:  # pixelHits DataFrames
+#       mon.update(chunk)
+#   mon.snapshot()
+#   mon.plot()
+#
+# Maps are indexed [x, y] as in pixelHits_maps() (PixelID = x * n_pixels + y).
+
+import os
+import time
+import numpy as np
+from tools.analysis_pixelHits import PIXEL_ID, ENERGY_keV, TOT, TOA
+from tools.utils import get_stop_string
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+
+class PixelHitsMonitor:
+    """
+    Accumulated detector images and spectra, fed by update(pixelHits chunk)
+    n_pixels: number of pixels per side
+    max_keV, bin_keV: energy spectrum range and bin width (higher energies are counted in overflow_keV)
+    max_ToT: ToT spectrum range (one bin per ToT unit), only filled if chunks have a ToT column
+    snapshot_path: .npz file written every snapshot_every_s seconds during update() (None: only on snapshot())
+    half_life_s: if set, past contents decay with this half-life (wall time), i.e. rolling maps of the recent hits
+    """
+
+    def __init__(self, n_pixels=256, max_keV=200, bin_keV=1., max_ToT=1024, snapshot_path=None,
+                 snapshot_every_s=60., half_life_s=None):
+        self.n_pixels = n_pixels
+        self.bin_keV = bin_keV
+        self.edges_keV = np.arange(0, max_keV + bin_keV / 2, bin_keV)
+        self.max_ToT = max_ToT
+        self.snapshot_path = snapshot_path
+        self.snapshot_every_s = snapshot_every_s
+        self.half_life_s = half_life_s
+        self.reset()
+
+    def reset(self):
+        n = self.n_pixels
+        self.counts = np.zeros((n, n))
+        self.energy = np.zeros((n, n))
+        self.tot = np.zeros((n, n))
+        self.spectrum_keV = np.zeros(len(self.edges_keV) - 1)
+        self.spectrum_ToT = np.zeros(self.max_ToT)
+        self.overflow_keV = 0.
+        self.n_hits = 0
+        self.n_chunks = 0
+        self.toa_range_ns = [np.inf, -np.inf]
+        self.start_time = self.last_update = self.last_snapshot = time.time()
+
+    def _decay(self, now):
+        f = 0.5 ** ((now - self.last_update) / self.half_life_s)
+        for a in (self.counts, self.energy, self.tot, self.spectrum_keV, self.spectrum_ToT):
+            a *= f
+        self.overflow_keV *= f
+
+    def update(self, pixelHits):
+        """
+        Add a chunk of pixel hits (DataFrame with PixelID and Energy (keV), optionally ToT and ToA)
+        """
+        now = time.time()
+        if self.half_life_s:
+            self._decay(now)
+        self.last_update = now
+        if not len(pixelHits):
+            return self
+
+        n = self.n_pixels * self.n_pixels
+        ids = pixelHits[PIXEL_ID].to_numpy(dtype=np.int64)
+        E = pixelHits[ENERGY_keV].to_numpy(dtype=float)
+        self.counts += np.bincount(ids, minlength=n).reshape(self.counts.shape)
+        self.energy += np.bincount(ids, weights=E, minlength=n).reshape(self.energy.shape)
+
+        bins = np.floor(E / self.bin_keV).astype(np.int64)
+        inside = (bins >= 0) & (bins < len(self.spectrum_keV))
+        self.spectrum_keV += np.bincount(bins[inside], minlength=len(self.spectrum_keV))
+        self.overflow_keV += np.count_nonzero(~inside)
+
+        if TOT in pixelHits.columns:
+            tot = pixelHits[TOT].to_numpy(dtype=float)
+            self.tot += np.bincount(ids, weights=tot, minlength=n).reshape(self.tot.shape)
+            t = tot.astype(np.int64)
+            t = t[(t >= 0) & (t < self.max_ToT)]
+            self.spectrum_ToT += np.bincount(t, minlength=self.max_ToT)
+        if TOA in pixelHits.columns:
+            toa = pixelHits[TOA].to_numpy()
+            self.toa_range_ns = [min(self.toa_range_ns[0], toa.min()), max(self.toa_range_ns[1], toa.max())]
+
+        self.n_hits += len(ids)
+        self.n_chunks += 1
+        if self.snapshot_path and now - self.last_snapshot >= self.snapshot_every_s:
+            self.snapshot()
+        return self
+
+    def rate_Hz(self):
+        """
+        Hits per second per pixel, over the ToA range of the hits received (None if no ToA)
+        """
+        span_ns = self.toa_range_ns[1] - self.toa_range_ns[0]
+        if not np.isfinite(span_ns) or span_ns <= 0:
+            return None
+        return self.counts / (span_ns * 1e-9)
+
+    def mean_energy(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.counts > 0, self.energy / self.counts, 0.)
+
+    def snapshot(self, file_path=None):
+        """
+        Save maps and spectra in file_path (default snapshot_path) as .npz
+        Written to a temporary file first, so that a reader never sees a partial snapshot
+        """
+        stime = time.time()
+        file_path = str(file_path or self.snapshot_path)
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        tmp = file_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, counts=self.counts, energy=self.energy, tot=self.tot, spectrum_keV=self.spectrum_keV,
+                     edges_keV=self.edges_keV, spectrum_ToT=self.spectrum_ToT, overflow_keV=self.overflow_keV,
+                     n_hits=self.n_hits, n_chunks=self.n_chunks, toa_range_ns=np.asarray(self.toa_range_ns),
+                     elapsed_s=time.time() - self.start_time)
+        os.replace(tmp, file_path)
+        self.last_snapshot = time.time()
+        global_log.debug(f"Monitor snapshot {file_path}: {self.n_hits} hits, {get_stop_string(stime)}")
+        return file_path
+
+    @classmethod
+    def load(cls, file_path):
+        """
+        Monitor restored from a snapshot (e.g. to plot it, or to continue accumulating)
+        """
+        with np.load(file_path) as f:
+            edges = f['edges_keV']
+            bin_keV = edges[1] - edges[0]
+            mon = cls(n_pixels=f['counts'].shape[0], max_keV=edges[-1], bin_keV=bin_keV,
+                      max_ToT=len(f['spectrum_ToT']))
+            for name in ('counts', 'energy', 'tot', 'spectrum_keV', 'spectrum_ToT'):
+                getattr(mon, name)[...] = f[name]
+            mon.overflow_keV = float(f['overflow_keV'])
+            mon.n_hits, mon.n_chunks = int(f['n_hits']), int(f['n_chunks'])
+            mon.toa_range_ns = list(f['toa_range_ns'])
+        return mon
+
+    def plot(self, log_scale=True):
+        import matplotlib.pyplot as plt
+        import matplotlib.colors as mcolors
+
+        fig, ax = plt.subplots(2, 3, figsize=(16, 9))
+        show = dict(origin='lower', extent=[0, self.n_pixels, 0, self.n_pixels], interpolation='nearest')
+        norm = mcolors.LogNorm if log_scale else mcolors.Normalize
+        for a, m, label in zip(ax[0], (self.counts, self.energy, self.tot),
+                               ('Count', 'Energy (keV)', 'ToT')):
+            h = a.imshow(m.T, norm=norm(), **show)
+            fig.colorbar(h, ax=a, label=label)
+            a.set_title(f'{label} map')
+            a.set_xlabel('Pixel x')
+            a.set_ylabel('Pixel y')
+
+        ax[1][0].imshow(self.mean_energy().T, **show)
+        ax[1][0].set_title('Mean energy per hit (keV)')
+        ax[1][1].stairs(self.spectrum_keV, self.edges_keV)
+        ax[1][1].set_xlabel('Energy (keV)')
+        ax[1][2].stairs(self.spectrum_ToT, np.arange(self.max_ToT + 1))
+        ax[1][2].set_xlabel('ToT')
+        for a in ax[1][1:]:
+            a.set_ylabel('Count')
+            if log_scale:
+                a.set_yscale('log')
+        plt.suptitle(f'{self.n_hits} hits, {self.n_chunks} chunks')
+        plt.tight_layout()
+        plt.show()
+        return fig, ax
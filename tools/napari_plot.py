@@ -28,6 +28,7 @@ def plot_stack_napari(z_slice_stack, vsize):
 
 
 def plot_reconstruction_napari(vol, vsize, vpitch, detector=False):
+    # vol can be a np.memmap or zarr array (e.g. from reco_bp(..., out=...)), napari then reads slices lazily
 
     # plt.imshow(vol[128,:,:])
     # plt.show()
@@ -0,0 +1,201 @@
+# Pipeline runner with stage-level checkpointing
+# Stages are declared with their function and parameters, and run in declaration order.
+# Each stage output is saved in cache_dir with a fingerprint of:
+#  - the function (module and name)
+#  - its parameters (numbers, strings, lists, arrays, dataframes...)
+#  - the size/modification time of the input files declared in 'files' (path parameters are only fingerprinted as
+#    strings: a stage writing to a path given as parameter, e.g. compact_hits_file(in, out_path), stays cached)
+#  - the fingerprints of upstream stages (parameters given as pipe.add(...) return values)
+# A stage is only recomputed if its fingerprint changed (or its cached output/'outputs' files are missing), e.g. changing
+# vpitch of the reconstruction does not rerun Allpix2 or clustering.
+# Stages using live state set by an upstream stage (e.g. Allpix2 needs an initialized opengate simulation) declare it
+# with requires=[...]: the required stages are rerun before them, even if cached.
+#
+# Example:
+#   pipe = Pipeline('output/pipeline')
+#   pipe.add('simulation', sim.run, outputs=[hits_path], key=sim_key)
+#   hits = pipe.add('pixelHits', gHits2allpix2pixelHits, sim, npix, config='precise', files=[hits_path],
+#                   requires=['simulation'])
+#   clusters = pipe.add('pixelClusters', pixelHits2pixelClusters, hits, npix=npix, window_ns=100, f='meas_calib')
+#   vol = pipe.add('reco', reco_bp, cones, vpitch=0.1, vsize=vs)
+#   pipe.run()
+#   volume = pipe.output('reco')
+
+import os
+import json
+import time
+import pickle
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from tools.utils import get_stop_string
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+
+class StageRef:
+    """Placeholder for the output of a stage, to be used as parameter of downstream stages"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return f"StageRef({self.name})"
+
+
+class Pipeline:
+    def __init__(self, cache_dir='output/pipeline'):
+        self.cache_dir = Path(cache_dir)
+        self.stages = {}  # name -> dict(func, args, kwargs, files, outputs, key)
+        self.fingerprints = {}
+        self.outputs = {}
+
+    def add(self, name, func, *args, files=(), outputs=(), key=None, requires=(), **kwargs):
+        """
+        Declare a stage computing func(*args, **kwargs).
+        files: input files whose changes invalidate the stage (read from parameters or via an object like sim),
+               paths also listed in outputs are ignored
+        outputs: files written by the stage, which must exist for its cached output to be reused
+        key: extra value included in the fingerprint, for parameters that cannot be fingerprinted
+             (e.g. opengate objects, which are only identified by their type)
+        requires: names of upstream stages that must have run in this session before this stage runs
+                  (live side effects, e.g. sim.run() initializing the simulation), rerun if they were cached
+        Returns a StageRef that can be passed as parameter of other stages.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already declared")
+        for r in requires:
+            if r not in self.stages:
+                raise ValueError(f"Stage {name} requires {r}, which must be declared before")
+        self.stages[name] = dict(func=func, args=args, kwargs=kwargs, files=[str(f) for f in files],
+                                 outputs=[str(f) for f in outputs], key=key, requires=list(requires))
+        return StageRef(name)
+
+    # ===========================
+    # ==  FINGERPRINTS         ==
+    # ===========================
+
+    def _fp_value(self, v):
+        if isinstance(v, StageRef):
+            return ['stage', self.fingerprints[v.name]]
+        if v is None or isinstance(v, (bool, int, float)):
+            return v
+        if isinstance(v, (str, Path)):
+            return str(v)
+        if isinstance(v, (list, tuple)):
+            return [self._fp_value(x) for x in v]
+        if isinstance(v, dict):
+            return {str(k): self._fp_value(x) for k, x in sorted(v.items(), key=lambda kv: str(kv[0]))}
+        if isinstance(v, (np.integer, np.floating)):
+            return v.item()
+        if isinstance(v, np.ndarray):
+            return ['ndarray', str(v.dtype), list(v.shape), hashlib.sha256(np.ascontiguousarray(v).tobytes()).hexdigest()]
+        if isinstance(v, (pd.DataFrame, pd.Series)):
+            return ['pandas', list(map(str, getattr(v, 'columns', []))),
+                    str(pd.util.hash_pandas_object(v, index=True).sum())]
+        if callable(v):
+            return ['callable', getattr(v, '__module__', ''), getattr(v, '__qualname__', repr(v))]
+        global_log.debug(f"Pipeline: parameter of type {type(v).__name__} not fingerprinted, use key=...")
+        return ['object', type(v).__module__, type(v).__qualname__]
+
+    def _fingerprint(self, name):
+        st = self.stages[name]
+        content = dict(func=self._fp_value(st['func']),
+                       args=self._fp_value(list(st['args'])),
+                       kwargs=self._fp_value(st['kwargs']),
+                       files=[[f] + _file_stats(f) for f in st['files'] if f not in st['outputs']],
+                       key=self._fp_value(st['key']))
+        return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+    # ===========================
+    # ==  EXECUTION            ==
+    # ===========================
+
+    def _paths(self, name):
+        return self.cache_dir / f"{name}.json", self.cache_dir / f"{name}.pkl"
+
+    def _is_cached(self, name, fp):
+        meta_path, out_path = self._paths(name)
+        if not (meta_path.is_file() and out_path.is_file()):
+            return False
+        if not all(os.path.isfile(f) for f in self.stages[name]['outputs']):
+            return False
+        with open(meta_path) as f:
+            return json.load(f)['fingerprint'] == fp
+
+    def output(self, name):
+        """Output of a stage, loaded from the cache if it was not computed in this session"""
+        if name not in self.outputs:
+            with open(self._paths(name)[1], 'rb') as f:
+                self.outputs[name] = pickle.load(f)
+        return self.outputs[name]
+
+    def _resolve(self, v):
+        if isinstance(v, StageRef):
+            return self.output(v.name)
+        if isinstance(v, list):
+            return [self._resolve(x) for x in v]
+        if isinstance(v, tuple):
+            return tuple(self._resolve(x) for x in v)
+        if isinstance(v, dict):
+            return {k: self._resolve(x) for k, x in v.items()}
+        return v
+
+    def run(self, until=None, force=()):
+        """
+        Run stages in declaration order, up to and including 'until' (default: all stages).
+        Stages whose fingerprint matches the cached one are skipped (their output is loaded only if needed).
+        force: names of stages to recompute anyway.
+        Returns the output of the last stage run.
+        """
+        stime = time.time()
+        global_log.info(f"Pipeline: START")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        names = list(self.stages)
+        if until is not None:
+            names = names[:names.index(until) + 1]
+
+        # Fingerprints are computed just before each stage, after upstream stages have (re)written their files
+        ran = set()
+        for name in names:
+            fp = self._fingerprint(name)
+            self.fingerprints[name] = fp
+            if name not in force and self._is_cached(name, fp):
+                global_log.info(f"Pipeline [{name}]: up to date, using cached output")
+                continue
+            self._execute(name, ran)
+
+        global_log.info(f"Pipeline: {get_stop_string(stime)}")
+        return self.output(names[-1]) if names else None
+
+    def _execute(self, name, ran):
+        st = self.stages[name]
+        stale = [r for r in st['requires'] if r not in ran]
+        if stale:
+            global_log.info(f"Pipeline [{name}]: rerunning {', '.join(stale)} first (required live)")
+            for r in stale:
+                self._execute(r, ran)
+            self.fingerprints[name] = self._fingerprint(name)  # required stages may have rewritten input files
+        global_log.info(f"Pipeline [{name}]: running")
+        out = st['func'](*self._resolve(list(st['args'])), **self._resolve(st['kwargs']))
+        self.outputs[name] = out
+        ran.add(name)
+        meta_path, out_path = self._paths(name)
+        with open(out_path, 'wb') as f:
+            pickle.dump(out, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(meta_path, 'w') as f:
+            json.dump(dict(fingerprint=self.fingerprints[name], function=getattr(st['func'], '__qualname__', ''),
+                           time=time.time()), f)
+
+
+def _file_stats(file_path):
+    if not os.path.isfile(file_path):
+        return []
+    s = os.stat(file_path)
+    return [s.st_size, s.st_mtime_ns]
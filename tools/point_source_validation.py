@@ -1,5 +1,6 @@
 from tools.reco_backprojection import *
 from tools.utils import get_stop_string
+from tools.utils_profiling import instrument
 import numpy as xp
 import matplotlib.pyplot as plt
 import time
@@ -30,8 +31,12 @@ except ImportError:
 # - time resolution (pile-up, singles with different eventID, true_coinc)
 # - energy/spatial resolution
 
+@instrument('source validation')
 def valid_psource(cones_df, src_pos, vpitch, vsize, plot_seq=False,
-                  plot_stk=False):
+                  plot_stk=False, apex_cache=None):
+    """
+    apex_cache: optional VoxelDirectionCache (see reco_bp), useful since cones are reconstructed one by one
+    """
     stime = time.time()
     global_log.info(f'Offline [source validation]: START')
     if not len(cones_df):
@@ -50,7 +55,7 @@ def valid_psource(cones_df, src_pos, vpitch, vsize, plot_seq=False,
     nb = 0  # number of bad cones
     cones_df = cones_df.reset_index(drop=True)
     for idx, cone in cones_df.iterrows():
-        vol = reco_bp(cone.to_frame().T, vpitch, vsize)
+        vol = reco_bp(cone.to_frame().T, vpitch, vsize, apex_cache=apex_cache)
         z_slice = vol[:, :, sp_vox[2]]
         z_slice_stack[idx, :, :] = z_slice
         if z_slice[sp_vox[0], sp_vox[1]] == 0:
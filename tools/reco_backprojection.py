@@ -9,6 +9,9 @@ except ImportError:
     global_log.addHandler(logging.NullHandler())
 
 from tools.display_reconstruction import *
+import time
+from collections import OrderedDict
+import numpy as np
 import numpy as xp
 
 try:
@@ -16,37 +19,177 @@ try:
 except ImportError:
     global_log.warning(f"Cupy is not installed. Using numpy instead.")
 
+min_tolerance = 0.001  # smallest cone half-width in cosT when using per-cone errors
 
-def reco_bp(cones_df, vpitch, vsize, det=False):
+
+def reco_volume_memmap(file_path, vsize, mode='w+'):
+    """
+    Create (or open with mode='r'/'r+') a float32 memory-mapped volume that reco_bp() can write into.
+    Shape is (vsize[1], vsize[0], vsize[2]), i.e. the axis order returned by reco_bp().
+    The file can be displayed lazily with plot_reconstruction_napari().
+    """
+    return np.memmap(file_path, dtype=np.float32, mode=mode,
+                     shape=(vsize[1], vsize[0], vsize[2]))
+
+
+class VoxelDirectionCache:
+    """
+    LRU cache of unit voxel-direction fields (voxel - apex, normalized), for reco_bp(..., apex_cache=cache)
+    Apexes are quantized to quantum_mm (e.g. pixel pitch): cones from the same pixel and depth share a field,
+    which reduces them to one dot product with the cone direction. This approximates apex positions,
+    check the effect with reco_cache_accuracy().
+    max_MB: memory budget, least recently used fields are evicted beyond it (one field = 12 bytes per voxel)
+    """
+
+    def __init__(self, quantum_mm=0.055, max_MB=1024):
+        self.quantum_mm = quantum_mm
+        self.max_bytes = max_MB * 1e6
+        self.fields = OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def quantize(self, apexes):
+        return np.round(np.asarray(apexes, dtype=float) / self.quantum_mm).astype(np.int64)
+
+    def get(self, key, compute):
+        if key in self.fields:
+            self.hits += 1
+            self.fields.move_to_end(key)
+            return self.fields[key]
+        self.misses += 1
+        field = compute()
+        self.fields[key] = field
+        self.nbytes += field.nbytes
+        while self.nbytes > self.max_bytes and len(self.fields) > 1:
+            _, old = self.fields.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+        return field
+
+    def clear(self):
+        self.fields.clear()
+        self.nbytes = 0
+
+    def __repr__(self):
+        return (f"VoxelDirectionCache({len(self.fields)} fields, {self.nbytes / 1e6:.0f}/{self.max_bytes / 1e6:.0f} MB, "
+                f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions)")
+
+
+def _unit_field(X, Y, Z, apex):
+    voxel_vec = xp.stack([X - apex[0], Y - apex[1], Z - apex[2]], axis=-1)
+    voxel_distances = xp.linalg.norm(voxel_vec, axis=-1)
+    return (voxel_vec / xp.expand_dims(voxel_distances, axis=-1)).astype(xp.float32)
+
+
+def reco_bp(cones_df, vpitch, vsize, det=False, out=None, slab=None, tolerance=0.01, apex_cache=None):
+    """
+    out: optional array to write the volume into instead of returning an in-memory one
+     - np.memmap (see reco_volume_memmap), zarr array, h5py dataset, ... (anything supporting slice assignment)
+     - must have shape (vsize[1], vsize[0], vsize[2])
+    slab: number of x-slices reconstructed at once (default: whole volume, or 16 if out is given)
+     => only one slab and its temporaries are held in memory
+    tolerance: half-width of the cones in cosT, or None to use the 'error' column of each cone
+     (uncertainty on cosT, see tools/compton.py), at least min_tolerance. Cones without error (0 or NaN, e.g. ground
+     truth cones from gHits2cones_byEvtID(sigma_E_keV=0.) or synthetic cones) are rejected: give a tolerance instead
+    apex_cache: optional VoxelDirectionCache, reusing unit voxel-direction fields across cones with the same
+     quantized apex (approximation, see reco_cache_accuracy())
+    """
     if len(cones_df) > 1:  # avoid logging when used in point source validation
         global_log.info(f'Reconstructing volume with backprojection')
 
-    volume = xp.zeros(vsize, dtype=xp.float32)
+    if out is not None and tuple(out.shape) != (vsize[1], vsize[0], vsize[2]):
+        raise ValueError(f"out has shape {out.shape}, expected {(vsize[1], vsize[0], vsize[2])}")
+    if slab is None:
+        slab = vsize[0] if out is None else 16
+
+    apexes = cones_df[['Apex_X', 'Apex_Y', 'Apex_Z']].to_numpy(dtype=float)
+    directions = cones_df[['Direction_X', 'Direction_Y', 'Direction_Z']].to_numpy(dtype=float)
+    cosTs = cones_df['cosT'].to_numpy(dtype=float)
+    if tolerance is None:
+        errors = cones_df['error'].to_numpy(dtype=float)
+        n_exact = np.count_nonzero(~(errors > 0))
+        if n_exact:
+            raise ValueError(f"tolerance=None uses the cone errors, but {n_exact}/{len(errors)} cones have no error "
+                             f"(exact/ground truth cones): give a tolerance, or build cones with sigma_E_keV > 0")
+        tolerances = np.maximum(errors, min_tolerance)
+    else:
+        tolerances = np.full(len(cosTs), tolerance)
+    if apex_cache is not None:
+        # cones with the same quantized apex are consecutive => one field computed per apex and slab
+        q = apex_cache.quantize(apexes)
+        order = np.lexsort(q.T[::-1])
+        q, apexes, directions = q[order], (q[order] * apex_cache.quantum_mm), directions[order]
+        cosTs, tolerances = cosTs[order], tolerances[order]
+    apexes, directions = xp.asarray(apexes), xp.asarray(directions)
+
+    volume = xp.zeros(vsize, dtype=xp.float32) if out is None else None
     grid_x = xp.linspace(-vsize[0] // 2, vsize[0] // 2, vsize[0]) * vpitch
     grid_y = xp.linspace(-vsize[1] // 2, vsize[1] // 2, vsize[1]) * vpitch
     grid_z = xp.linspace(-vsize[2] // 2, vsize[2] // 2, vsize[2]) * vpitch
-    X, Y, Z = xp.meshgrid(grid_x, grid_y, grid_z, indexing='ij')
 
-    for _, c in cones_df.iterrows():
-        apex = xp.array([c['Apex_X'], c['Apex_Y'], c['Apex_Z']])
-        d = xp.array([c['Direction_X'], c['Direction_Y'], c['Direction_Z']])
-        cosT = c['cosT']
+    for x0 in range(0, vsize[0], slab):
+        x1 = min(x0 + slab, vsize[0])
+        X, Y, Z = xp.meshgrid(grid_x[x0:x1], grid_y, grid_z, indexing='ij')
+        vol_slab = xp.zeros(X.shape, dtype=xp.float32)
 
-        # Compute distance from apex to each voxel
-        voxel_vec = xp.stack([X - apex[0], Y - apex[1], Z - apex[2]], axis=-1)
-        voxel_distances = xp.linalg.norm(voxel_vec, axis=-1)
+        for i, (apex, d, cosT, tol) in enumerate(zip(apexes, directions, cosTs, tolerances)):
+            if apex_cache is None:
+                # Compute distance from apex to each voxel
+                voxel_vec = xp.stack([X - apex[0], Y - apex[1], Z - apex[2]], axis=-1)
+                voxel_distances = xp.linalg.norm(voxel_vec, axis=-1)
 
-        # Compute angle with direction vector
-        vox_vec_norm = voxel_vec / xp.expand_dims(voxel_distances, axis=-1)
-        dot_products = xp.sum(vox_vec_norm * d, axis=-1)
+                # Compute angle with direction vector
+                vox_vec_norm = voxel_vec / xp.expand_dims(voxel_distances, axis=-1)
+                dot_products = xp.sum(vox_vec_norm * d, axis=-1)
+            else:
+                key = (vpitch, tuple(vsize), x0, x1) + tuple(q[i].tolist())
+                vox_vec_norm = apex_cache.get(key, lambda: _unit_field(X, Y, Z, apex))
+                dot_products = vox_vec_norm @ d.astype(xp.float32)
 
-        # Compute mask of voxels satisfying the Compton cone condition
-        tolerance = 0.01  # Adjust tolerance as needed
-        cone_mask = xp.abs(dot_products - cosT) < tolerance
+            # Compute mask of voxels satisfying the Compton cone condition
+            cone_mask = xp.abs(dot_products - cosT) < tol
 
-        # Accumulate contribution to the volume
-        volume[cone_mask] += 1
+            # Accumulate contribution to the volume
+            vol_slab[cone_mask] += 1
+
+        if out is None:
+            volume[x0:x1] = vol_slab
+        else:
+            vol_slab = xp.swapaxes(vol_slab, 0, 1)
+            if xp.__name__ == 'cupy': vol_slab = xp.asnumpy(vol_slab)
+            out[:, x0:x1, :] = vol_slab
+
+    if out is not None:
+        if hasattr(out, 'flush'): out.flush()
+        return out
 
     volume = xp.swapaxes(volume, 0, 1)
 
     return volume
+
+
+def reco_cache_accuracy(cones_df, vpitch, vsize, apex_cache=None, **kwargs):
+    """
+    Compare reco_bp() with and without apex_cache (default: VoxelDirectionCache()) on the same cones.
+    Returns a dict with timings, cache statistics and differences between both volumes:
+     - max_abs_diff, rel_l1_diff = sum|cached - exact| / sum(exact)
+     - voxels_diff = fraction of voxels with different values
+     - correlation between both volumes
+    """
+    apex_cache = VoxelDirectionCache() if apex_cache is None else apex_cache
+    t0 = time.perf_counter()
+    exact = reco_bp(cones_df, vpitch, vsize, **kwargs)
+    t1 = time.perf_counter()
+    cached = reco_bp(cones_df, vpitch, vsize, apex_cache=apex_cache, **kwargs)
+    t2 = time.perf_counter()
+    if xp.__name__ == 'cupy':
+        exact, cached = xp.asnumpy(exact), xp.asnumpy(cached)
+    exact, cached = np.asarray(exact, dtype=float), np.asarray(cached, dtype=float)
+    diff = np.abs(cached - exact)
+    report = dict(n_cones=len(cones_df), time_exact_s=t1 - t0, time_cached_s=t2 - t1,
+                  cache_hits=apex_cache.hits, cache_misses=apex_cache.misses,
+                  max_abs_diff=diff.max(), rel_l1_diff=diff.sum() / max(exact.sum(), 1),
+                  voxels_diff=np.count_nonzero(diff) / diff.size,
+                  correlation=np.corrcoef(exact.ravel(), cached.ravel())[0, 1])
+    global_log.info(f"Apex cache accuracy: " + ", ".join(f"{k}={v:.4g}" for k, v in report.items()))
+    return report
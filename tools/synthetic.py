@@ -0,0 +1,266 @@
+# Fast synthetic Compton camera data, without Geant4/Gate or Allpix2
+# Produces pixel hits, clusters, cones and Gate-like hits files in the same formats as the simulation chain,
+# e.g. to profile or regression-test the offline stages at arbitrary rates on a plain CPU.
+#
+# Model (single Timepix3 layer, sensor not rotated, facing the source along +z):
+# - point/sphere/box source emitting mono-energetic gammas towards the sensor
+# - exponential attenuation in the sensor (mu_per_mm), photo-electric or Compton (compton_fraction)
+# - Compton angle sampled from Klein-Nishina, scattered gamma absorbed if it interacts in the sensor
+# - charge cloud shared over 3x3 pixels (gaussian with diffusion), threshold on pixel energy
+# - ToA = emission time + drift time to the pixels (at local z = +0.5) from charge_speed_mm_ns()
+# - pile-up comes from the source activity: emission times follow a Poisson process
+
+import time
+import numpy as np
+import pandas as pd
+import uproot
+from tools.analysis_pixelHits import PIXEL_ID, PIX_X_ID, PIX_Y_ID, PIX_Z_ID, TOA, ENERGY_keV, EVENTID, \
+    pixelHits_columns, simulation_columns
+from tools.analysis_cones import cones_columns
+from tools.utils import get_pixID, get_stop_string, global_log_debug_df
+from tools.utils_profiling import instrument
+from tools.compton import ELECTRON_MASS_keV, compton_cosT
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+# Columns of the interactions dataframe (one row per energy deposit)
+# Position_X/Y/Z are global coordinates in mm, X/Y/Z local fractional coordinates (see analysis_pixelClusters)
+interactions_columns = [EVENTID, 'Process', 'Time (ns)', 'Position_X', 'Position_Y', 'Position_Z',
+                        PIX_X_ID, PIX_Y_ID, PIX_Z_ID, ENERGY_keV, 'Direction_X', 'Direction_Y', 'Direction_Z']
+COMPTON, PHOTO = 'compt', 'phot'
+
+
+def _erf(x):
+    # Abramowitz & Stegun 7.1.26, |error| < 1.5e-7, vectorized
+    s = np.sign(x)
+    x = np.abs(x)
+    t = 1 / (1 + 0.3275911 * x)
+    y = 1 - (((((1.061405429 * t - 1.453152027) * t) + 1.421413741) * t - 0.284496736) * t + 0.254829592) * t * np.exp(-x * x)
+    return s * y
+
+
+def _sample_klein_nishina(E_keV, rng):
+    """
+    Sample cos(theta) of Compton scattering from the Klein-Nishina cross-section (rejection sampling)
+    """
+    k = E_keV / ELECTRON_MASS_keV
+    cos = np.empty(len(E_keV))
+    todo = np.arange(len(E_keV))
+    while len(todo):
+        c = rng.uniform(-1, 1, len(todo))
+        eps = 1 / (1 + k[todo] * (1 - c))
+        accept = rng.uniform(0, 1, len(todo)) < 0.5 * eps ** 2 * (eps + 1 / eps - (1 - c ** 2))
+        cos[todo[accept]] = c[accept]
+        todo = todo[~accept]
+    return cos
+
+
+def _rotate(d, cos, rng):
+    """
+    Rotate unit vectors d by polar angle acos(cos) and uniform azimuth
+    """
+    phi = rng.uniform(0, 2 * np.pi, len(d))
+    sin = np.sqrt(1 - cos ** 2)
+    # Orthonormal basis (u, v) perpendicular to d
+    a = np.where(np.abs(d[:, [0]]) < 0.9, [[1., 0, 0]], [[0, 1., 0]])
+    u = np.cross(d, a)
+    u /= np.linalg.norm(u, axis=1)[:, None]
+    v = np.cross(d, u)
+    return cos[:, None] * d + sin[:, None] * (np.cos(phi)[:, None] * u + np.sin(phi)[:, None] * v)
+
+
+@instrument('synthetic')
+def generate_interactions(n_events=None, activity_Bq=None, duration_s=None, source_keV=140,
+                          source_position_mm=(0, 0, -5), source_shape='point', source_size_mm=0,
+                          npix=256, pitch_mm=0.055, thickness_mm=1, sensor_position_mm=(0, 0, 5),
+                          mu_per_mm=0.35, compton_fraction=0.3, seed=None):
+    """
+    Generate gamma interactions in the sensor.
+    Use either n_events (1 us between events, no pile-up) or activity_Bq and duration_s (Poisson emission times).
+    Only gammas emitted towards the sensor are simulated, the others are not counted in EventID.
+
+    source_shape: 'point', 'sphere' (source_size_mm = radius) or 'box' (source_size_mm = list of x,y,z sizes)
+    mu_per_mm: linear attenuation coefficient of the sensor (CdTe at 140 keV ~ 0.35/mm)
+    compton_fraction: probability that the 1st interaction is Compton scattering (else photo-electric)
+
+    Returns a DataFrame with interactions_columns, sorted by EventID (Compton before photo-electric)
+    """
+    stime = time.time()
+    global_log.info(f"Offline [synthetic]: START")
+    rng = np.random.default_rng(seed)
+
+    if n_events is None:
+        n_events = rng.poisson(activity_Bq * duration_s)
+        t_emit = np.sort(rng.uniform(0, duration_s * 1e9, n_events))  # ns
+    else:
+        t_emit = np.arange(n_events) * 1e3
+
+    # Source positions
+    src = np.tile(np.asarray(source_position_mm, dtype=float), (n_events, 1))
+    if source_shape == 'sphere':
+        d = rng.normal(size=(n_events, 3))
+        r = source_size_mm * rng.uniform(0, 1, n_events) ** (1 / 3)
+        src += d / np.linalg.norm(d, axis=1)[:, None] * r[:, None]
+    elif source_shape == 'box':
+        src += rng.uniform(-0.5, 0.5, (n_events, 3)) * np.asarray(source_size_mm)
+    elif source_shape != 'point':
+        raise ValueError(f"Unknown source shape {source_shape}")
+
+    # Isotropic directions within the cone containing the sensor (as theta_phi() in utils_opengate)
+    sens = np.asarray(sensor_position_mm, dtype=float)
+    half = npix * pitch_mm / 2
+    front_z = sens[2] - thickness_mm / 2
+    dist = front_z - np.asarray(source_position_mm)[2]
+    if dist <= 0:
+        raise ValueError("Source must be on the -z side of the sensor")
+    cos_max = np.cos(np.arctan((np.sqrt(2) * half + (np.max(source_size_mm) if source_shape != 'point' else 0)) / dist))
+    cos = rng.uniform(cos_max, 1, n_events)
+    phi = rng.uniform(0, 2 * np.pi, n_events)
+    sin = np.sqrt(1 - cos ** 2)
+    d0 = np.column_stack([sin * np.cos(phi), sin * np.sin(phi), cos])
+
+    # 1st interaction point
+    entry = src + d0 * ((front_z - src[:, 2]) / d0[:, 2])[:, None]
+    p1 = entry + d0 * rng.exponential(1 / mu_per_mm, n_events)[:, None]
+
+    def inside(p):
+        return (np.all(np.abs(p[:, :2] - sens[:2]) < half, axis=1)
+                & (np.abs(p[:, 2] - sens[2]) < thickness_mm / 2))
+
+    hit = inside(p1) & np.all(np.abs(entry[:, :2] - sens[:2]) < half, axis=1)
+    evt, t_emit, d0, p1 = np.nonzero(hit)[0], t_emit[hit], d0[hit], p1[hit]
+    E0 = np.full(len(evt), float(source_keV))
+
+    # Compton scattering: energy deposit E1 and scattered gamma (E0-E1), absorbed if it interacts in the sensor
+    compt = rng.uniform(0, 1, len(evt)) < compton_fraction
+    cosT = _sample_klein_nishina(E0[compt], rng)
+    E_scat = E0[compt] / (1 + E0[compt] / ELECTRON_MASS_keV * (1 - cosT))
+    d1 = _rotate(d0[compt], cosT, rng)
+    p2 = p1[compt] + d1 * rng.exponential(1 / mu_per_mm, len(d1))[:, None]
+    absorbed = inside(p2)
+
+    first = pd.DataFrame({
+        EVENTID: evt, 'Process': np.where(compt, COMPTON, PHOTO), 'Time (ns)': t_emit,
+        'Position_X': p1[:, 0], 'Position_Y': p1[:, 1], 'Position_Z': p1[:, 2],
+        ENERGY_keV: np.where(compt, 0., E0),
+        'Direction_X': d0[:, 0], 'Direction_Y': d0[:, 1], 'Direction_Z': d0[:, 2],
+    })
+    first.loc[compt, ENERGY_keV] = E0[compt] - E_scat
+    first.loc[compt, ['Direction_X', 'Direction_Y', 'Direction_Z']] = d1
+    second = pd.DataFrame({
+        EVENTID: evt[compt][absorbed], 'Process': PHOTO, 'Time (ns)': t_emit[compt][absorbed],
+        'Position_X': p2[absorbed, 0], 'Position_Y': p2[absorbed, 1], 'Position_Z': p2[absorbed, 2],
+        ENERGY_keV: E_scat[absorbed],
+        'Direction_X': d1[absorbed, 0], 'Direction_Y': d1[absorbed, 1], 'Direction_Z': d1[absorbed, 2],
+    })
+    df = pd.concat([first, second], ignore_index=True)
+    df[PIX_X_ID] = (df['Position_X'] - sens[0]) / pitch_mm + npix / 2 - 0.5
+    df[PIX_Y_ID] = (df['Position_Y'] - sens[1]) / pitch_mm + npix / 2 - 0.5
+    df[PIX_Z_ID] = (df['Position_Z'] - sens[2]) / thickness_mm
+    df = df[interactions_columns].sort_values([EVENTID, 'Process'], kind='stable', ignore_index=True)
+
+    global_log.debug(f"{n_events} gammas emitted, {len(evt)} interacting, {compt.sum()} Compton, "
+                     f"{absorbed.sum()} Compton + photo-electric")
+    global_log_debug_df(df)
+    global_log.info(f"Offline [synthetic]: {get_stop_string(stime)}")
+    return df
+
+
+def interactions2pixelHits(interactions, charge_speed_mm_ns, thickness_mm=1, npix=256, pitch_mm=0.055,
+                           sigma0_um=5, diffusion_um_sqrt_mm=15, threshold_keV=2, seed=None):
+    """
+    Share the energy of each interaction over 3x3 pixels and compute their ToA.
+    Charge cloud sigma = sigma0_um + diffusion_um_sqrt_mm * sqrt(drift distance in mm).
+    ToA is quantized to 1.5625 ns (Timepix3 fine ToA).
+    Returns a DataFrame with simulation_columns + pixelHits_columns, sorted by ToA
+    """
+    rng = np.random.default_rng(seed)
+    it = interactions
+    drift_mm = (0.5 - it[PIX_Z_ID].to_numpy()) * thickness_mm
+    sigma = (sigma0_um + diffusion_um_sqrt_mm * np.sqrt(drift_mm)) / (pitch_mm * 1e3)  # in pixels
+    x, y = it[PIX_X_ID].to_numpy(), it[PIX_Y_ID].to_numpy()
+    cx, cy = np.rint(x).astype(int), np.rint(y).astype(int)
+
+    # Fraction of the charge collected by each of the 3x3 pixels around the central one
+    off = np.array([-1, 0, 1])
+
+    def frac(pos, c):
+        lo = (c[:, None] + off - 0.5 - pos[:, None]) / (np.sqrt(2) * sigma[:, None])
+        hi = (c[:, None] + off + 0.5 - pos[:, None]) / (np.sqrt(2) * sigma[:, None])
+        return 0.5 * (_erf(hi) - _erf(lo))
+
+    f = frac(x, cx)[:, :, None] * frac(y, cy)[:, None, :]  # (n, 3, 3)
+    E = it[ENERGY_keV].to_numpy()[:, None, None] * f
+    px = np.broadcast_to(cx[:, None, None] + off[:, None], E.shape)
+    py = np.broadcast_to(cy[:, None, None] + off[None, :], E.shape)
+    toa = it['Time (ns)'].to_numpy() + drift_mm / charge_speed_mm_ns
+    toa = np.broadcast_to(toa[:, None, None], E.shape)
+    evt = np.broadcast_to(it[EVENTID].to_numpy()[:, None, None], E.shape)
+
+    keep = (E > threshold_keV) & (px >= 0) & (px < npix) & (py >= 0) & (py < npix)
+    toa = np.ceil((toa[keep] + rng.uniform(0, 0.1, keep.sum())) / 1.5625) * 1.5625
+    df = pd.DataFrame({
+        EVENTID: evt[keep],
+        PIXEL_ID: get_pixID(px[keep], py[keep], n_pixels=npix),
+        TOA: toa,
+        ENERGY_keV: E[keep],
+    })
+    # Same pixel fired twice in an event (overlapping clouds) -> one hit with summed energy
+    df = df.groupby([EVENTID, PIXEL_ID], as_index=False).agg({TOA: 'min', ENERGY_keV: 'sum'})
+    df = df.sort_values(TOA, kind='stable', ignore_index=True)
+    return df[simulation_columns + pixelHits_columns]
+
+
+def interactions2pixelClusters(interactions, charge_speed_mm_ns, thickness_mm=1):
+    """
+    Ideal clusters (one per interaction) in the 'simu_calib' format of pixelHits2pixelClusters()
+    """
+    it = interactions
+    drift_mm = (0.5 - it[PIX_Z_ID].to_numpy()) * thickness_mm
+    df = it[[EVENTID, PIX_X_ID, PIX_Y_ID, ENERGY_keV]].copy()
+    df[TOA] = it['Time (ns)'].to_numpy() + drift_mm / charge_speed_mm_ns
+    return df.sort_values(TOA, kind='stable', ignore_index=True)
+
+
+def interactions2cones(interactions, source_keV=140):
+    """
+    Ideal cones (global coordinates, mm) from events with a Compton and a photo-electric interaction (error = 0)
+    """
+    it = interactions
+    n = it.groupby(EVENTID)[EVENTID].transform('size')
+    it = it[n == 2]
+    c, p = it[it['Process'] == COMPTON], it[it['Process'] == PHOTO]
+    pos = ['Position_X', 'Position_Y', 'Position_Z']
+    apex = c[pos].to_numpy()
+    d = apex - p[pos].to_numpy()
+    d /= np.linalg.norm(d, axis=1)[:, None]
+    E1 = c[ENERGY_keV].to_numpy()
+    cosT = compton_cosT(source_keV, E1)
+    return pd.DataFrame(np.column_stack([c[EVENTID].to_numpy(), apex, d, cosT, np.zeros(len(c))]),
+                        columns=cones_columns).astype({EVENTID: int})
+
+
+def interactions2gHits(interactions, file_path):
+    """
+    Write a minimal Gate-like 'Hits' tree (MeV, mm, ns) readable by gHits2cones_byEvtID().
+    Each interaction is a step of the primary gamma (TrackID 1), recoil electrons are not tracked.
+    """
+    it = interactions
+    hits = {
+        'EventID': it[EVENTID].to_numpy(dtype=np.int32),
+        'TrackID': np.ones(len(it), dtype=np.int32),
+        'ParentID': np.zeros(len(it), dtype=np.int32),
+        'TotalEnergyDeposit': it[ENERGY_keV].to_numpy() / 1e3,
+        'GlobalTime': it['Time (ns)'].to_numpy() + np.where(it['Process'] == PHOTO, 1e-3, 0),
+    }
+    for ax in 'XYZ':
+        hits[f'PostPosition_{ax}'] = it[f'Position_{ax}'].to_numpy()
+        hits[f'PostDirection_{ax}'] = it[f'Direction_{ax}'].to_numpy()
+    with uproot.recreate(file_path) as f:
+        f['Hits'] = hits
+    return file_path
@@ -0,0 +1,131 @@
+# Raw Timepix3 data-driven readout (.tpx3) -> pixel hits, without the Pixet .t3pa text export
+# The file is a stream of little-endian 64-bit packets, memory-mapped and decoded chunk by chunk with NumPy bit operations.
+#  - chunk headers (SPIDR/Pixet): 'TPX3' in the 4 lowest bytes, then chip index, mode and chunk size => skipped
+#  - pixel packets: 4 highest bits = 0xB (data-driven ToA + ToT), other packets (TDC, global time...) are ignored
+# Pixel packet fields:
+#   dcol = (pkt >> 52) & 0xFE, spix = (pkt >> 45) & 0xFC, pix = (pkt >> 44) & 0x7
+#   x = dcol + pix // 4, y = spix + (pix & 3)  => Matrix Index = y * 256 + x (as in .t3pa files)
+#   ToA = (pkt >> 30) & 0x3FFF (14 bits), ToT = (pkt >> 20) & 0x3FF (10 bits), FToA = (pkt >> 16) & 0xF,
+#   spidr = pkt & 0xFFFF (16 bits SPIDR time stamp)
+# Coarse time = spidr << 14 | ToA (25 ns ticks), 30 bits => rolls over every ~26.8 s, unwrapped over the whole file.
+# Time calibration is the same as pixet2pixelHit(): ToA (ns) = 25 * ToA - 25 / 16 * FToA
+#
+# Example:
+#   pixelHits = tpx3Raw2pixelHit('run.tpx3', calib='./minipix/')
+#   for chunk in tpx3_pixelHits_chunks('run.tpx3', calib='./minipix/'):  # streaming, e.g. to PixelHitsMonitor
+#       mon.update(chunk)
+
+import os
+import time
+import numpy as np
+import pandas as pd
+from tools.analysis_pixelHits import PIXEL_ID, TOA, ENERGY_keV, apply_pixel_mask, load_pixel_mask
+from tools.calibration import PixetCalibration
+from tools.utils import get_stop_string, global_log_debug_df
+from tools.utils_profiling import instrument
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+TPX3_HEADER = np.uint64(int.from_bytes(b'TPX3', 'little'))
+PIXEL_PACKET = 0xB
+COARSE_BITS = 30  # spidr (16) + ToA (14)
+
+
+def _u(v):
+    return np.uint64(v)
+
+
+def decode_tpx3_packets(packets, n_pixels=256):
+    """
+    Pixel packets (uint64) -> DataFrame with the .t3pa columns: Matrix Index, ToA (coarse 25 ns ticks, 30 bits,
+    not unwrapped), ToT, FToA. Chunk headers and non-pixel packets are dropped.
+    """
+    pkt = np.asarray(packets, dtype=np.uint64)
+    pkt = pkt[((pkt & _u(0xFFFFFFFF)) != TPX3_HEADER) & ((pkt >> _u(60)) == _u(PIXEL_PACKET))]
+
+    dcol = (pkt >> _u(52)) & _u(0xFE)
+    spix = (pkt >> _u(45)) & _u(0xFC)
+    pix = (pkt >> _u(44)) & _u(0x7)
+    x = dcol + (pix >> _u(2))
+    y = spix + (pix & _u(3))
+    toa = (pkt >> _u(30)) & _u(0x3FFF)
+    spidr = pkt & _u(0xFFFF)
+    return pd.DataFrame({
+        'Matrix Index': (y * _u(n_pixels) + x).astype(np.int64),
+        'ToA': ((spidr << _u(14)) | toa).astype(np.int64),
+        'ToT': ((pkt >> _u(20)) & _u(0x3FF)).astype(np.int32),
+        'FToA': ((pkt >> _u(16)) & _u(0xF)).astype(np.int8),
+    })
+
+
+def read_tpx3_chunks(file_path, chunk_MB=64, n_pixels=256):
+    """
+    Generator of decoded pixel packets (see decode_tpx3_packets) from a memory-mapped .tpx3 file, chunk_MB at a time.
+    ToA is unwrapped across coarse time rollovers over the whole file (packets can arrive slightly out of order:
+    a jump of more than half the range backwards is a rollover, forwards is a late packet from the previous period).
+    """
+    size = os.path.getsize(file_path)
+    n = size // 8
+    if size % 8:
+        global_log.warning(f"{file_path}: {size % 8} trailing bytes ignored (not a multiple of 64-bit packets)")
+    if n == 0:
+        return
+    data = np.memmap(file_path, dtype='<u8', mode='r', shape=(n,))
+    step = max(1, int(chunk_MB * 2 ** 20) // 8)
+    half, period = 1 << (COARSE_BITS - 1), 1 << COARSE_BITS
+    last, epoch = None, 0
+    for i in range(0, n, step):
+        df = decode_tpx3_packets(data[i:i + step], n_pixels=n_pixels)
+        if not len(df):
+            continue
+        coarse = df['ToA'].to_numpy()
+        prev = np.concatenate(([coarse[0] if last is None else last], coarse[:-1]))
+        d = coarse - prev
+        wraps = epoch + np.cumsum((d < -half).astype(np.int64) - (d > half))
+        last, epoch = coarse[-1], wraps[-1]
+        df['ToA'] = coarse + wraps * period
+        yield df
+    del data
+
+
+def tpx3_pixelHits_chunks(file_path, calib, chipID=None, mask=None, lut=False, chunk_MB=64):
+    """
+    Generator of pixel hits DataFrames (same columns as pixet2pixelHit) from a raw .tpx3 file
+    calib, chipID, mask, lut: see pixet2pixelHit(), lut=True builds one table for all the chunks
+    """
+    calib = PixetCalibration.load(calib, chipID=chipID)
+    if lut is True:
+        lut = calib.build_lut()
+    if isinstance(mask, str) and mask == 'calib':
+        mask = load_pixel_mask(calib.directory)
+    for df in read_tpx3_chunks(file_path, chunk_MB=chunk_MB, n_pixels=calib.n_pixels):
+        if mask is not None:
+            df = apply_pixel_mask(df, mask, id_column='Matrix Index')
+        ids = df['Matrix Index'].to_numpy()
+        yield pd.DataFrame({
+            PIXEL_ID: ids,
+            TOA: 25 * df['ToA'].to_numpy() - (25 / 16) * df['FToA'].to_numpy(),
+            ENERGY_keV: calib.energy(df['ToT'].to_numpy(), ids, lut=lut),
+        })
+
+
+@instrument('pixelHits')
+def tpx3Raw2pixelHit(file_path, calib, chipID=None, mask=None, lut=False, chunk_MB=64):
+    """
+    Raw Timepix3 data-driven file (.tpx3) -> pixel hits DataFrame, as pixet2pixelHit() for .t3pa files
+    """
+    global_log.info(f"Offline [pixelHits]: START")
+    global_log.debug(f"Inputs:\n{file_path}\n{calib}")
+    stime = time.time()
+    chunks = list(tpx3_pixelHits_chunks(file_path, calib, chipID=chipID, mask=mask, lut=lut, chunk_MB=chunk_MB))
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=[PIXEL_ID, TOA, ENERGY_keV])
+    if len(df) == 0:
+        global_log.error(f"Empty pixel hits dataframe, probably no hit produced.")
+    global_log_debug_df(df)
+    global_log.info(f"Offline [pixelHits]: {get_stop_string(stime)}")
+    return df
@@ -3,6 +3,7 @@
 import sys
 import time
 import numpy as np
+import pandas as pd
 import importlib.metadata
 
 try:
@@ -175,8 +176,9 @@ def localFractional2globalCoordinates(c, sensor, npix):
 
     a, b, c = np.array(a), np.array(b), np.array(c)
 
+    # c can be one point (3,) or many (n, 3)
     bc = b + c
-    bc = np.dot(sensor.rotation, bc) * [pitch, pitch, sensor.size[2]]
+    bc = bc @ np.asarray(sensor.rotation).T * [pitch, pitch, sensor.size[2]]
 
     g = a + bc
 
@@ -191,8 +193,9 @@ def global2localFractionalCoordinates(g, sensor, npix):
 
     a, b, g = np.array(a), np.array(b), np.array(g)
 
+    # g can be one point (3,) or many (n, 3)
     bc = -a + g
-    bc = np.dot(sensor.rotation.T, bc) / [pitch, pitch, sensor.size[2]]
+    bc = bc @ np.asarray(sensor.rotation) / [pitch, pitch, sensor.size[2]]
 
     c = bc - b
 
@@ -213,4 +216,24 @@ def charge_speed_mm_ns(mobility_cm2_Vs, bias_V, thick_mm):
 def check_gate_version():
     if importlib.metadata.version("opengate") != "10.0.1":
         global_log.error("opengate version not supported: pip install opengate==10.0.1")
-        sys.exit()
\ No newline at end of file
+        sys.exit()
+
+HITS_CATEGORIES = 'Hits_categories'  # TObjString with the categories of coded string branches (JSON)
+
+
+def read_hits(file_path, columns=None, **kwargs):
+    """
+    Read the Gate 'Hits' tree as a DataFrame, decoding string branches coded by compact_hits_file()
+    (tools/utils_opengate.py) into pandas categoricals, which compare to strings as usual (e.g. hits['ParticleName'] == 'gamma')
+    columns: branches to read (default all), kwargs: passed to uproot arrays() (e.g. entry_start, entry_stop)
+    """
+    import json
+    import uproot
+    with uproot.open(file_path) as f:
+        # flat branches: numpy arrays => strings as objects, without the awkward-pandas dependency of library='pd'
+        hits = pd.DataFrame(f['Hits'].arrays(columns, library='np', **kwargs))
+        if HITS_CATEGORIES in f:
+            for name, cats in json.loads(str(f[HITS_CATEGORIES])).items():
+                if name in hits.columns:
+                    hits[name] = pd.Categorical.from_codes(hits[name].to_numpy(), categories=cats)
+    return hits
@@ -1,11 +1,14 @@
 # Utility function when using opengate
 
 import os
+import time
 from pathlib import Path
 import numpy as np
 from opengate.logger import global_log
 from opengate.geometry.volumes import RepeatParametrisedVolume
 from opengate.utility import g4_units
+from tools.utils import get_stop_string, HITS_CATEGORIES
+from tools.utils_profiling import instrument
 
 um, mm, keV, MeV, deg, Bq, sec = g4_units.um, g4_units.mm, g4_units.keV, g4_units.MeV, g4_units.deg, g4_units.Bq, g4_units.s
 
@@ -86,4 +89,100 @@ def get_isotope_data(source):
     except Exception as e:
         messages.append(f"Error reading file: {e}")
 
-    return "\n".join(messages)
\ No newline at end of file
+    return "\n".join(messages)
+
+# ===========================
+# ==  HITS FILE SIZE       ==
+# ===========================
+# Hits attributes (Gate names, 3-vectors are stored as _X/_Y/_Z branches) read by each offline stage
+# Use hits.attributes = hits_attributes([...]) instead of all available attributes to get smaller/faster hits files
+hits_attributes_per_stage = {
+    'allpix': ['EventID', 'TotalEnergyDeposit', 'GlobalTime', 'Position', 'HitUniqueVolumeID', 'PDGCode', 'TrackID',
+               'ParentID'],  # branch_names of the DepositionReader in tools/allpix.py
+    'singles': ['EventID', 'TotalEnergyDeposit', 'GlobalTime', 'PostPosition', 'HitUniqueVolumeID',
+                'PreStepUniqueVolumeID'],  # DigitizerAdderActor and singles2pixelHits()
+    'cones': ['EventID', 'TrackID', 'ParentID', 'TotalEnergyDeposit', 'GlobalTime', 'KineticEnergy',
+              'TrackCreatorProcess', 'PrePosition', 'PostPosition', 'PreDirection', 'PostDirection'],  # gHits2cones_byEvtID()
+    'visualizer': ['EventID', 'TrackID', 'TotalEnergyDeposit', 'KineticEnergy', 'Position', 'ParticleName'],
+    'print': ['EventID', 'TrackID', 'ParentID', 'ParticleName', 'ParentParticleName', 'ProcessDefinedStep',
+              'TrackCreatorProcess', 'TrackCreatorModelName', 'TotalEnergyDeposit', 'KineticEnergy', 'GlobalTime',
+              'PreGlobalTime', 'LocalTime', 'TimeFromBeginOfEvent', 'TrackProperTime', 'TrackLength', 'StepLength',
+              'PrePosition', 'PostPosition', 'PreDirection', 'PostDirection', 'HitUniqueVolumeID'],  # print_hits_*()
+}
+# Branches kept as they are by compact_hits_file() (Allpix2 reads them with fixed types)
+hits_time_attributes = ['GlobalTime', 'PreGlobalTime', 'LocalTime', 'TimeFromBeginOfEvent', 'TrackProperTime']
+
+
+def hits_attributes(stages):
+    """
+    Minimal list of hits attributes for the offline stages that will be run, e.g. ['allpix', 'cones']
+    Stages: see hits_attributes_per_stage
+    """
+    unknown = set(stages) - set(hits_attributes_per_stage)
+    if unknown:
+        raise ValueError(f"Unknown stages {unknown}, use {list(hits_attributes_per_stage)}")
+    attributes = []
+    for stage in stages:
+        attributes += [a for a in hits_attributes_per_stage[stage] if a not in attributes]
+    return attributes
+
+
+def _branches(attributes, names):
+    return [n for n in names if n in attributes or n.rsplit('_', 1)[0] in attributes]
+
+
+@instrument('compact hits')
+def compact_hits_file(file_path, output_path=None, keep=None, float32=True, step_size='100 MB'):
+    """
+    Rewrite a Gate hits file with:
+     - string branches (ParticleName, ProcessDefinedStep...) as int32 codes, categories saved as JSON in HITS_CATEGORIES
+     - float branches as float32 if float32=True, except times (hits_time_attributes)
+    Branches of the attributes in keep (default: Allpix2 ones) are not modified, except that strings are
+    written as char* strings. Read compact files with tools/utils.py read_hits(), which decodes the strings.
+    The output is a TTree (created with mktree, uproot >= 5 would write an RNTuple for a dict), readable by Allpix2.
+    output_path: default <file>_compact.root next to file_path, the input file is never modified
+    """
+    import json
+    import uproot
+    import awkward as ak
+
+    stime = time.time()
+    global_log.info(f"Offline [compact hits]: START")
+    keep = hits_attributes(['allpix']) if keep is None else keep
+    if output_path is None:
+        output_path = os.path.splitext(str(file_path))[0] + '_compact.root'
+    if os.path.abspath(output_path) == os.path.abspath(file_path):
+        raise ValueError(f"output_path must differ from the input file {file_path}")
+    tmp_path = str(output_path) + '.tmp'
+    size_in = os.path.getsize(file_path)
+
+    categories = {}  # branch -> {string: code}
+    with uproot.open(file_path) as fin, uproot.recreate(tmp_path) as fout:
+        tree = fin['Hits']
+        kept = _branches(keep, tree.keys())
+        times = _branches(hits_time_attributes, tree.keys())
+        for chunk in tree.iterate(step_size=step_size, library='np'):
+            out = {}
+            for name, a in chunk.items():
+                is_str = a.dtype.kind in 'OUST'  # uproot versions return strings as object or unicode arrays
+                if is_str and name not in kept:
+                    cat = categories.setdefault(name, {})
+                    uniq, inv = np.unique(a.astype(str), return_inverse=True)
+                    out[name] = np.array([cat.setdefault(str(u), len(cat)) for u in uniq], dtype=np.int32)[inv]
+                elif is_str:
+                    out[name] = ak.Array(a.astype(str).tolist())
+                elif float32 and a.dtype == np.float64 and name not in kept + times:
+                    out[name] = a.astype(np.float32)
+                else:
+                    out[name] = a
+            if 'Hits' not in fout:
+                fout.mktree('Hits', {k: v.type if isinstance(v, ak.Array) else v.dtype for k, v in out.items()})
+            fout['Hits'].extend(out)
+        fout[HITS_CATEGORIES] = json.dumps({k: list(v) for k, v in categories.items()})
+    os.replace(tmp_path, output_path)
+
+    size_out = os.path.getsize(output_path)
+    global_log.info(f"Offline [compact hits]: {size_in / 1e6:.1f} MB -> {size_out / 1e6:.1f} MB "
+                    f"({len(categories)} string branches coded)")
+    global_log.info(f"Offline [compact hits]: {get_stop_string(stime)}")
+    return output_path
@@ -0,0 +1,123 @@
+# Instrumentation of the offline stages (functions logging 'Offline [...]: START')
+# Each call of an @instrument-ed function adds a record to run_report: wall time, rows in/out, throughput, and the
+# peak RSS of the process so far (process_peak_rss_MB, a high-water mark: not the memory of this stage, it stays the
+# same after the biggest stage). The peak memory of each stage is tracemalloc_peak_MB, recorded with trace_memory=True.
+# Optionally (see configure_instrumentation), each stage is also profiled with cProfile and/or tracemalloc.
+# Save the report with save_run_report('output/run_report.json') (or .csv) at the end of a script.
+
+import os
+import sys
+import json
+import time
+import cProfile
+import tracemalloc
+import functools
+
+try:
+    import resource
+except ImportError:  # Windows without WSL
+    resource = None
+
+try:
+    from opengate.logger import global_log
+except ImportError:
+    import logging
+    global_log = logging.getLogger("dummy")
+    global_log.addHandler(logging.NullHandler())
+
+run_report = []  # one dict per stage call, see instrument()
+report_columns = ['stage', 'function', 'start', 'wall_s', 'rows_in', 'rows_out', 'rows_per_s',
+                  'process_peak_rss_MB', 'tracemalloc_peak_MB', 'profile']
+_settings = {'profile': False, 'trace_memory': False, 'output_dir': 'output/profiles'}
+_active = []  # stages currently running (profilers only attach to the outermost one)
+
+
+def configure_instrumentation(profile=False, trace_memory=False, output_dir='output/profiles'):
+    """
+    profile: save a cProfile .prof file per stage call in output_dir (view with snakeviz, pstats...)
+    trace_memory: record the tracemalloc peak of each stage call, i.e. its own peak memory (slows down the code)
+    """
+    _settings.update(profile=profile, trace_memory=trace_memory, output_dir=output_dir)
+
+
+def _n_rows(obj):
+    if isinstance(obj, tuple) and obj:  # e.g. valid_psource returns (stack, vsize)
+        obj = obj[0]
+    if obj is None or isinstance(obj, (str, bytes, os.PathLike)) or not hasattr(obj, '__len__'):
+        return None
+    return len(obj)
+
+
+def _process_peak_rss_MB():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3  # bytes on MacOS, kB on Linux
+
+
+def instrument(stage):
+    """
+    Decorator recording a run_report entry for each call of an offline stage.
+    Rows in = length of the 1st positional argument (if it is a dataframe/array), rows out = length of the output.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            outermost = not _active
+            profiler, tracing = None, False
+            if outermost and _settings['profile']:
+                profiler = cProfile.Profile()
+            if outermost and _settings['trace_memory'] and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                tracing = True
+            _active.append(stage)
+            start = time.time()
+            stime = time.perf_counter()
+            try:
+                if profiler:
+                    profiler.enable()
+                out = func(*args, **kwargs)
+            finally:
+                if profiler:
+                    profiler.disable()
+                wall = time.perf_counter() - stime
+                _active.pop()
+                peak = None
+                if tracing:
+                    peak = tracemalloc.get_traced_memory()[1] / 1e6
+                    tracemalloc.stop()
+
+            prof_path = None
+            if profiler:
+                os.makedirs(_settings['output_dir'], exist_ok=True)
+                prof_path = os.path.join(_settings['output_dir'], f"{func.__name__}_{len(run_report)}.prof")
+                profiler.dump_stats(prof_path)
+            rows_in = _n_rows(args[0]) if args else None
+            run_report.append(dict(stage=stage, function=func.__name__, start=start, wall_s=wall,
+                                   rows_in=rows_in, rows_out=_n_rows(out),
+                                   rows_per_s=rows_in / wall if rows_in and wall else None,
+                                   process_peak_rss_MB=_process_peak_rss_MB(), tracemalloc_peak_MB=peak,
+                                   profile=prof_path))
+            return out
+
+        return wrapper
+
+    return decorator
+
+
+def save_run_report(file_path):
+    """
+    Save run_report as JSON (list of records) or CSV, according to the file extension
+    """
+    if file_path.endswith('.csv'):
+        import pandas
+        pandas.DataFrame(run_report, columns=report_columns).to_csv(file_path, index=False)
+    else:
+        with open(file_path, 'w') as f:
+            json.dump(run_report, f, indent=1)
+    global_log.info(f"Run report with {len(run_report)} stage calls saved to {file_path}")
+
+
+def clear_run_report():
+    run_report.clear()